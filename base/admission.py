@@ -0,0 +1,145 @@
+
+import collections
+import logging
+import threading
+import time
+
+import {Middleware, g, update, reply_text, end_update} from './app'
+import {TokenBucket} from './ratelimit'
+
+
+class AdmissionController(Middleware):
+  """
+  A #Middleware that sheds load before an update reaches any handler or
+  the database. Every user and chat has a #TokenBucket that limits the
+  rate of their updates; an update is only admitted if both buckets have a
+  token left. Messages that waited more than *max_age* seconds in the
+  updater's queue are shed as well, so that a backlog after a burst is
+  drained quickly instead of being answered long after the fact.
+
+  Shed updates are answered with *message* (at most once per
+  *notice_interval* seconds per chat) and counted in #counters, which are
+  logged every *log_interval* seconds. This middleware should be added
+  before any other middleware.
+  """
+
+  def __init__(self, user_rate=1.0, user_burst=5, chat_rate=3.0, chat_burst=15,
+               max_age=30.0, max_buckets=10000, notice_interval=10.0,
+               log_interval=300.0, logger=None,
+               message="Slow down! I'm receiving too many messages right now."):
+    self.user_rate = user_rate
+    self.user_burst = user_burst
+    self.chat_rate = chat_rate
+    self.chat_burst = chat_burst
+    self.max_age = max_age
+    self.max_buckets = max_buckets
+    self.notice_interval = notice_interval
+    self.log_interval = log_interval
+    self.logger = logger or logging.getLogger('admission')
+    self.message = message
+    self.counters = collections.Counter()
+    self._user_buckets = collections.OrderedDict()
+    self._chat_buckets = collections.OrderedDict()
+    self._notices = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._logged = time.monotonic()
+
+  @classmethod
+  def from_config(cls, config):
+    return cls(
+      user_rate=config.get('userRate', 1.0),
+      user_burst=config.get('userBurst', 5),
+      chat_rate=config.get('chatRate', 3.0),
+      chat_burst=config.get('chatBurst', 15),
+      max_age=config.get('maxAge', 30.0),
+      notice_interval=config.get('noticeInterval', 10.0),
+      log_interval=config.get('logInterval', 300.0)
+    )
+
+  def stats(self):
+    """
+    Returns a dictionary of the counters of admitted and shed updates.
+    """
+
+    with self._lock:
+      return dict(self.counters)
+
+  def before_handle_update(self):
+    self._log_stats()
+
+    message = update.message
+    if self.max_age and message and message.date:
+      if time.time() - message.date.timestamp() > self.max_age:
+        self.shed('stale')
+
+    user, chat = update.effective_user, update.effective_chat
+    reason = None
+    with self._lock:
+      # Check both buckets before taking a token from either, so that an
+      # update that is shed for its chat does not count against the user.
+      user_bucket = user and self._get_bucket(self._user_buckets, user.id,
+        self.user_rate, self.user_burst)
+      chat_bucket = chat and self._get_bucket(self._chat_buckets, chat.id,
+        self.chat_rate, self.chat_burst)
+      if user_bucket and user_bucket.delay() > 0:
+        reason = 'user'
+      elif chat_bucket and chat_bucket.delay() > 0:
+        reason = 'chat'
+      else:
+        for bucket in (user_bucket, chat_bucket):
+          if bucket:
+            bucket.consume()
+        self.counters['admitted'] += 1
+    if reason:
+      self.shed(reason)
+
+  def after_handle_update(self):
+    pass
+
+  def shed(self, reason):
+    """
+    Counts the current update as shed for the specified *reason*, tells the
+    chat to slow down and ends the update. The reason is available to later
+    middlewares as `g.shed_reason`.
+    """
+
+    g.shed_reason = reason
+    with self._lock:
+      self.counters['shed_' + reason] += 1
+      chat = update.effective_chat
+      notify = False
+      if chat:
+        now = time.monotonic()
+        last = self._notices.get(chat.id)
+        if last is None or now - last >= self.notice_interval:
+          self._store(self._notices, chat.id, now)
+          notify = True
+    if notify:
+      reply_text(self.message)
+    end_update()
+
+  def _log_stats(self):
+    if not self.log_interval:
+      return
+    now = time.monotonic()
+    with self._lock:
+      if now - self._logged < self.log_interval:
+        return
+      self._logged = now
+    self.logger.info('Admission counters: %s', self.stats())
+
+  def _get_bucket(self, buckets, key, rate, burst):
+    # Must be called with the lock held.
+    bucket = buckets.get(key)
+    if bucket is None:
+      bucket = TokenBucket(rate, burst)
+    self._store(buckets, key, bucket)
+    return bucket
+
+  def _store(self, mapping, key, value):
+    # Keeps the *mapping* in least-recently-used order and bounded to
+    # *max_buckets* entries. Must be called with the lock held.
+    mapping[key] = value
+    mapping.move_to_end(key)
+    while len(mapping) > self.max_buckets:
+      mapping.popitem(last=False)
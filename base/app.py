@@ -1,14 +1,17 @@
 
-from telegram.ext import Handler
 from werkzeug.local import Local, release_local
 import abc
 import collections
+import heapq
+import itertools
 import logging
 import re
+import threading
+import time
 import traceback
 
 Command = collections.namedtuple('Command', 'name text')
-CommandHandler = collections.namedtuple('CommandHandler', 'name func help')
+CommandHandler = collections.namedtuple('CommandHandler', 'name func help readonly')
 
 #: GLobal data available inside the application handlers.
 g = Local()
@@ -16,6 +19,7 @@ current_app = g('current_app')
 update = g('update')
 bot = g('bot')
 command = g('command')
+readonly = g('readonly')
 callback_middleware_result = g('callback_middleware_result')
 
 
@@ -24,6 +28,8 @@ def init_local(app, bot, update):
   g.update = update
   g.bot = bot
   g.command = None
+  g.readonly = False
+  g.deferred_chat_action = None
   g.callback_middleware_result = {}
 
 
@@ -59,18 +65,21 @@ class CallbackMiddleware(Middleware):
       result()
 
 
-class Application(Handler):
+class Application(object):
   """
-  This object represents a telegram bot application. The application is just
-  another telegram #Handler.
+  This object represents a telegram bot application. Use #handler() to get
+  a telegram #Handler for the application. python-telegram-bot is only
+  imported at that point, so that the application and its commands can be
+  inspected without loading it.
   """
 
-  def __init__(self, name, debug=False):
+  def __init__(self, name, debug=False, chat_action_delay=0.5):
     self.name = name
     self.logger = logging.Logger(name)
     self.debug = debug
+    self.chat_action_delay = chat_action_delay
     self._middleware = []
-    self.commands = {'help': CommandHandler('help', do_help, 'Show this help.')}
+    self.commands = {'help': CommandHandler('help', do_help, 'Show this help.', True)}
     self.message_handler = None
     self.edited_message_handler = None
     self.inline_query_handler = None
@@ -85,6 +94,28 @@ class Application(Handler):
     handler.setFormatter(logging.Formatter('[%(levelname)s -%(asctime)s]: %(message)s'))
     self.logger.addHandler(handler)
 
+  def handler(self):
+    """
+    Returns a #telegram.ext.Handler that passes all updates to this
+    application.
+    """
+
+    from telegram.ext import Handler
+    app = self
+
+    class ApplicationHandler(Handler):
+
+      def __init__(self):
+        super().__init__(app.handle_update)
+
+      def check_update(self, update):
+        return app.check_update(update)
+
+      def handle_update(self, update, dispatcher, *args, **kwargs):
+        return app.handle_update(update, dispatcher)
+
+    return ApplicationHandler()
+
   def check_update(self, update):
     # FIXME: If we wanted the #Application to function together with other
     #        telegram #Handler#s, we would need to properly check whether
@@ -95,6 +126,8 @@ class Application(Handler):
     init_local(self, dispatcher.bot, update)
     if update.message:
       g.command = parse_command(update.message.text)
+      handler = self.commands.get(g.command.name) if g.command else None
+      g.readonly = bool(handler and handler.readonly)
 
     try:
       for mw in self._middleware:
@@ -121,6 +154,7 @@ class Application(Handler):
       self.handle_exception(exc)
     finally:
       try:
+        cancel_deferred_chat_action()
         for mw in self._middleware:
           mw.after_handle_update()
       finally:
@@ -161,6 +195,9 @@ class Application(Handler):
       self.edited_channel_post_handler()
 
   def handle_exception(self, exc):
+    # Lets middlewares tell failed updates apart from handled ones, even if
+    # the traceback is sent to the chat in debug mode.
+    g.failed_reason = type(exc).__name__
     if self.exception_handler:
       self.exception_handler(exc)
     else:
@@ -176,11 +213,18 @@ class Application(Handler):
     else:
       self.logger.error('Update "%s" caused error "%s"', update, error)
 
-  def command(self, name_or_func=None, help=None):
+  def command(self, name_or_func=None, help=None, readonly=False):
+    """
+    Decorator to register a command handler. Commands that only read data
+    should be marked as *readonly*, which is exposed to middlewares as
+    #g.readonly while the command is handled (eg. to route database
+    queries to secondaries).
+    """
+
     name = name_or_func
     def decorator(func):
-      self.commands[name] = CommandHandler(
-        name or func.__name__, func, help or func.__doc__)
+      self.commands[name or func.__name__] = CommandHandler(
+        name or func.__name__, func, help or func.__doc__, readonly)
       return func
 
     if callable(name_or_func):
@@ -262,9 +306,12 @@ def reply_text(*args, **kwargs):
   See also #telegram.bot.Bot.sendMessage().
   """
 
+  chat = g.update.effective_chat
   chat_id = kwargs.pop('chat_id', None)
   if chat_id is None:
-    chat_id = g.update.effective_chat.id
+    chat_id = chat.id
+  if chat and chat_id == chat.id:
+    cancel_deferred_chat_action()
   g.bot.sendMessage(chat_id, *args, **kwargs)
 
 
@@ -279,6 +326,113 @@ def chat_action(action, *args, **kwargs):
   g.bot.send_chat_action(chat_id, action, **kwargs)
 
 
+class ChatActionScheduler(object):
+  """
+  Runs the #DeferredChatAction#s of all updates on a single daemon thread,
+  so that handling an update does not need to start a thread of its own.
+  The thread is started on first use.
+  """
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._queue = []
+    self._counter = itertools.count()
+    self._thread = None
+
+  def schedule(self, delay, action):
+    """
+    Calls `action._send()` after *delay* seconds.
+    """
+
+    with self._cond:
+      due = time.monotonic() + delay
+      heapq.heappush(self._queue, (due, next(self._counter), action))
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run,
+          name='ChatActionScheduler', daemon=True)
+        self._thread.start()
+      self._cond.notify()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._queue or self._queue[0][0] > time.monotonic():
+          timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+          self._cond.wait(timeout)
+        action = heapq.heappop(self._queue)[2]
+      action._send()
+
+
+chat_action_scheduler = ChatActionScheduler()
+
+
+class DeferredChatAction(object):
+  """
+  Sends a chat *action* to *chat_id* after *delay* seconds unless it is
+  cancelled before. Telegram only displays a chat action for about five
+  seconds, so it is repeated every *interval* seconds until #cancel() is
+  called. The action is sent with the lock held, so once #cancel()
+  returns, no action is sent anymore and none is in flight.
+  """
+
+  def __init__(self, bot, chat_id, action, delay, interval=4.5,
+               scheduler=chat_action_scheduler):
+    self.bot = bot
+    self.chat_id = chat_id
+    self.action = action
+    self.delay = delay
+    self.interval = interval
+    self.scheduler = scheduler
+    self._lock = threading.Lock()
+    self._cancelled = False
+
+  def start(self):
+    self.scheduler.schedule(self.delay, self)
+
+  def cancel(self):
+    with self._lock:
+      self._cancelled = True
+
+  def _send(self):
+    with self._lock:
+      if self._cancelled:
+        return
+      try:
+        self.bot.send_chat_action(self.chat_id, self.action)
+      except Exception:
+        logging.getLogger(__name__).exception('Could not send chat action.')
+      self.scheduler.schedule(self.interval, self)
+
+
+def deferred_chat_action(action, delay=None, **kwargs):
+  """
+  Like #chat_action(), but the action is only sent if the handler did not
+  reply to the current chat within *delay* seconds (defaults to the
+  application's *chat_action_delay*). The action is repeated until the
+  first #reply_text() or until the update has been handled. This saves a
+  round trip to Telegram for handlers that reply quickly.
+  """
+
+  chat_id = kwargs.pop('chat_id', None)
+  if chat_id is None:
+    chat_id = g.update.effective_chat.id
+  if delay is None:
+    delay = current_app.chat_action_delay
+  cancel_deferred_chat_action()
+  g.deferred_chat_action = DeferredChatAction(g.bot, chat_id, action, delay, **kwargs)
+  g.deferred_chat_action.start()
+
+
+def cancel_deferred_chat_action():
+  """
+  Cancels the pending #deferred_chat_action(), if any.
+  """
+
+  if g.deferred_chat_action:
+    g.deferred_chat_action.cancel()
+    g.deferred_chat_action = None
+
+
 def do_help():
   """
   Default help action.
@@ -0,0 +1,57 @@
+
+import threading
+import time
+
+
+class TokenBucket(object):
+  """
+  A thread-safe token bucket. The bucket holds up to *burst* tokens and is
+  refilled with *rate* tokens per second. Every unit of work consumes a token;
+  if the bucket is empty, the work must be delayed or dropped.
+  """
+
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def _refill(self, now):
+    elapsed = now - self.updated
+    if elapsed > 0:
+      self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+      self.updated = now
+
+  def consume(self, tokens=1):
+    """
+    Takes *tokens* from the bucket. Returns #False if there are not enough
+    tokens available, in which case the bucket is left untouched.
+    """
+
+    with self._lock:
+      self._refill(time.monotonic())
+      if self.tokens >= tokens:
+        self.tokens -= tokens
+        return True
+      return False
+
+  def delay(self, tokens=1):
+    """
+    Returns the number of seconds until *tokens* will be available.
+    """
+
+    with self._lock:
+      self._refill(time.monotonic())
+      missing = tokens - self.tokens
+      if missing <= 0:
+        return 0.0
+      return missing / self.rate
+
+  def wait(self, tokens=1):
+    """
+    Blocks until *tokens* could be taken from the bucket.
+    """
+
+    while not self.consume(tokens):
+      time.sleep(self.delay(tokens))
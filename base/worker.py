@@ -0,0 +1,42 @@
+
+import abc
+import logging
+import threading
+
+
+class Worker(threading.Thread, metaclass=abc.ABCMeta):
+  """
+  A daemon thread that calls #run_once() repeatedly until #stop() is called.
+  If #run_once() returns #True, there is more work to do and it is called
+  again right away, otherwise the worker sleeps for *interval* seconds.
+  """
+
+  def __init__(self, name, interval, logger=None):
+    super().__init__(name=name, daemon=True)
+    self.interval = interval
+    self.logger = logger or logging.getLogger(name)
+    self._shutdown = threading.Event()
+
+  def run(self):
+    while not self._shutdown.is_set():
+      try:
+        busy = self.run_once()
+      except Exception:
+        self.logger.exception('%s: Unhandled exception.', self.name)
+        busy = False
+      if not busy:
+        self._shutdown.wait(self.interval)
+
+  @abc.abstractmethod
+  def run_once(self):
+    pass
+
+  def stop(self, timeout=None):
+    """
+    Signals the worker to stop and waits for it to finish its current
+    iteration.
+    """
+
+    self._shutdown.set()
+    if self.is_alive():
+      self.join(timeout)
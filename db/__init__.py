@@ -1,19 +1,175 @@
 
 from datetime import datetime
 from mongoengine import *
+from pymongo import ReplaceOne
+from pymongo.read_preferences import SecondaryPreferred
+import collections
 import enum
 import decimal
+import itertools
+import re
+import threading
+import time
 import config from '../config.json'
 import {EnumField} from './fields'
+import {
+  Storage, Summary, RequestMode,
+  Record, UserRef, LedgerRow, RequestRow,
+  StorageError, InsufficientFunds, InvalidAmount, RequestStateError,
+  check_amount
+} from './storage'
 
 db = connect(**config['mongoDb'])
 decimal_context = decimal.Context(prec=2)
+read_config = config.get('readPreference', {})
+secondary_reads = read_config.get('secondaryReads', False)
+max_staleness = read_config.get('maxStalenessSeconds', -1)
+if secondary_reads and max_staleness < 90:
+  # Without a staleness bound, there is no point after which we could trust
+  # secondaries to have replicated a write, see #has_recent_write().
+  raise ValueError('readPreference.maxStalenessSeconds must be at least 90 '
+    'if readPreference.secondaryReads is enabled.')
+secondary_read_preference = SecondaryPreferred(max_staleness=max_staleness)
+
+_storage = None
+_routing = threading.local()
+_recent_writes = collections.OrderedDict()
+_recent_writes_lock = threading.Lock()
 
 
 def Decimal(number=0):
   return decimal.Decimal(number, decimal_context)
 
 
+def to_ledger_row(son, providers):
+  """
+  Converts a raw #LedgerEntry document *son* to a #LedgerRow. *providers*
+  maps the ids of #GatewayTransactionDetails to the provider name.
+  """
+
+  return LedgerRow(
+    son['_id'],
+    LedgerEntry.amount.to_python(son['amount']),
+    son.get('date'),
+    son.get('sender'),
+    son.get('receiver'),
+    providers.get(son.get('gateway_details')),
+    son.get('description')
+  )
+
+
+def get_storage():
+  """
+  Returns the #Storage implementation that is configured in the `storage`
+  section of the configuration. The SQL backend is only loaded if it is
+  used, as it requires SQLAlchemy.
+  """
+
+  global _storage
+  if _storage is None:
+    options = config.get('storage', {})
+    backend = options.get('backend', 'mongo')
+    if backend == 'mongo':
+      _storage = MongoStorage()
+    elif backend == 'sql':
+      _storage = require('./sql').SqlStorage(options.get('url', 'sqlite:///kwittbot.db'))
+    else:
+      raise ValueError('Unknown storage backend: {!r}'.format(backend))
+  return _storage
+
+
+def compact(cutoff, batch_size=1000):
+  """
+  Writes a #BalanceCheckpoint at *cutoff* for every user that participates
+  in a #Transaction up to then, and afterwards moves these transactions to
+  the #ArchivedTransaction collection in batches. Compaction can be resumed
+  safely if it was interrupted. Returns a tuple of the number of checkpoints
+  and the number of archived transactions.
+  """
+
+  old = Transaction.objects(date__lte=cutoff)
+  user_ids = set(old.distinct('sender')) | set(old.distinct('receiver'))
+  user_ids = set(getattr(x, 'id', x) for x in user_ids if x)
+
+  checkpoints = 0
+  for user in User.objects(id__in=list(user_ids)):
+    balance = user.balance_at(cutoff)
+    BalanceCheckpoint.objects(user=user, date=cutoff).update_one(
+      upsert=True, set__balance=balance)
+    checkpoints += 1
+
+  archive = ArchivedTransaction._get_collection()
+  archived = 0
+  while True:
+    batch = list(Transaction.objects(date__lte=cutoff).limit(batch_size).as_pymongo())
+    if not batch:
+      break
+    archive.bulk_write([ReplaceOne({'_id': t['_id']}, t, upsert=True) for t in batch], ordered=False)
+    Transaction.objects(id__in=[t['_id'] for t in batch]).delete()
+    archived += len(batch)
+
+  return checkpoints, archived
+
+
+def route_reads(secondary):
+  """
+  Enables or disables routing of queries in the current thread to
+  secondaries. Has no effect unless `readPreference.secondaryReads` is
+  enabled in the configuration.
+  """
+
+  _routing.secondary = secondary and secondary_reads
+
+
+def record_write(*users):
+  """
+  Records that the data of *users* has just been changed. Until the maximum
+  staleness of secondaries has passed, #has_recent_write() returns #True for
+  these users so that they are able to read their own writes. Nothing is
+  recorded if secondary reads are disabled.
+  """
+
+  if not secondary_reads:
+    return
+  now = time.monotonic()
+  with _recent_writes_lock:
+    # Keep the entries in the order of their last write, so that expired
+    # entries can be evicted from the front.
+    for user in users:
+      _recent_writes[user.id] = now
+      _recent_writes.move_to_end(user.id)
+
+
+def has_recent_write(user):
+  """
+  Returns #True if the data of *user* has been changed recently enough that
+  a secondary might not have replicated it, yet.
+  """
+
+  if not secondary_reads:
+    return False
+  now = time.monotonic()
+  with _recent_writes_lock:
+    while _recent_writes:
+      key, date = next(iter(_recent_writes.items()))
+      if now - date <= max_staleness:
+        break
+      del _recent_writes[key]
+    return user.id in _recent_writes
+
+
+class RoutedQuerySet(QuerySet):
+  """
+  A #QuerySet that reads from secondaries if #route_reads() has been
+  enabled in the thread that created it.
+  """
+
+  def __init__(self, document, collection):
+    super().__init__(document, collection)
+    if getattr(_routing, 'secondary', False):
+      self._read_preference = secondary_read_preference
+
+
 class User(Document):
 
   #: The ID of the bot's private chat with the user.
@@ -35,6 +191,10 @@ class User(Document):
   #: from the users transactions history.
   balance = DecimalField(precision=2)
 
+  meta = {
+    'queryset_class': RoutedQuerySet
+  }
+
   @classmethod
   def from_telegram_user(cls, chat, user):
     return cls(chat.id, user.id, user.username, user.name, user.language_code, 0.0)
@@ -46,28 +206,75 @@ class User(Document):
     history.
     """
 
-    balance = Decimal()
-    for t in self.get_transactions():
-      if t.receiver == t.sender:
-        # We use self-transactions for simple testing purposes.
-        # Skip them in the balance update.
-        continue
-      if t.receiver == self:
-        balance += t.amount
-      elif t.sender == self:
-        balance -= t.amount
-      else:
-        raise RuntimeError('User is not part of this transaction', t)
-    self.balance = balance
+    self.balance = self.compute_balance()
     self.save()
+    record_write(self)
+
+  def compute_balance(self):
+    """
+    Computes the user's current balance without updating the cached
+    #balance. See #balance_at().
+    """
 
-  def get_transactions(self):
+    return self.balance_at()
+
+  def balance_at(self, date=None):
+    """
+    Computes the user's balance at the specified *date*, or the current
+    balance if no date is specified. The balance is computed from the
+    nearest #BalanceCheckpoint before that date plus the transactions
+    since the checkpoint. Archived transactions are only read for dates in
+    the past, since the latest checkpoint always covers all of them.
+    """
+
+    checkpoint = BalanceCheckpoint.get_nearest(self, date)
+    balance = checkpoint.balance if checkpoint else Decimal()
+    since = checkpoint.date if checkpoint else None
+    sources = [Transaction]
+    if date is not None:
+      sources.append(ArchivedTransaction)
+
+    # Only the raw amount and the ids of the sender and receiver are read,
+    # no documents are built and no references are dereferenced.
+    to_amount = LedgerEntry.amount.to_python
+
+    # A transaction may exist in both collections if compaction was
+    # interrupted, make sure to count it only once.
+    seen = set()
+    for source in sources:
+      query = self.get_transactions(since, date, source)
+      for t in query.only('amount', 'sender', 'receiver').as_pymongo():
+        if t['_id'] in seen:
+          continue
+        seen.add(t['_id'])
+        sender, receiver = t.get('sender'), t.get('receiver')
+        if receiver == sender:
+          # We use self-transactions for simple testing purposes.
+          # Skip them in the balance update.
+          continue
+        if receiver == self.id:
+          balance += to_amount(t['amount'])
+        elif sender == self.id:
+          balance -= to_amount(t['amount'])
+        else:
+          raise RuntimeError('User is not part of this transaction', t)
+    return balance
+
+  def get_transactions(self, since=None, until=None, source=None):
     """
     Returns a query of all transactions that the user participates in
-    as a receiver or sender.
+    as a receiver or sender. The query can be limited to transactions
+    after *since* and up to and including *until*. By default, only the
+    #Transaction collection is queried, pass #ArchivedTransaction as the
+    *source* to query the archive instead.
     """
 
-    return Transaction.objects(Q(receiver=self) | Q(sender=self))
+    query = (source or Transaction).objects(Q(receiver=self) | Q(sender=self))
+    if since is not None:
+      query = query.filter(date__gt=since)
+    if until is not None:
+      query = query.filter(date__lte=until)
+    return query
 
   def get_requests(self, target=None):
     """
@@ -99,12 +306,14 @@ class GatewayTransactionDetails(Document):
   # TODO ...
 
 
-class Transaction(Document):
+class LedgerEntry(Document):
   """
   A transaction between users is always a positive amount of money transfered
   from the #sender to the #receiver. If there is no #sender, there must be a
   a #gateway_details object and the transaction represents one debited or
   credited to/from a Payment Gateway (eg. PayPal, etc.).
+
+  This is the abstract base of #Transaction and #ArchivedTransaction.
   """
 
   #: The amount of money being transfered from the #receiver to the #sender
@@ -130,6 +339,21 @@ class Transaction(Document):
   #: A text description of the transaction.
   description = StringField()
 
+  meta = {
+    'abstract': True,
+    'queryset_class': RoutedQuerySet,
+    'indexes': [('sender', 'date'), ('receiver', 'date'), 'date']
+  }
+
+  @property
+  def provider(self):
+    """
+    The ID of the payment provider if the transaction is one between a user
+    and a payment gateway, otherwise #None.
+    """
+
+    return self.gateway_details.provider if self.gateway_details else None
+
   def clean(self):
     if not self.date:
       self.date = datetime.now()
@@ -145,15 +369,58 @@ class Transaction(Document):
         'sender and receiver.')
 
 
+class Transaction(LedgerEntry):
+  """
+  A transaction in the hot ledger. Transactions older than the configured
+  retention are moved to the #ArchivedTransaction collection by #compact().
+  """
+
+
+class ArchivedTransaction(LedgerEntry):
+  """
+  A transaction that has been moved out of the hot ledger by #compact().
+  """
+
+
+class BalanceCheckpoint(Document):
+  """
+  The balance of a user at a specific point in time, including all
+  transactions up to and including #date. Checkpoints are written by
+  #compact() before the transactions they cover are archived.
+  """
+
+  #: The user that the checkpoint belongs to.
+  user = ReferenceField('User', reverse_delete_rule=DENY)
+
+  #: The date up to which the checkpoint covers the user's transactions.
+  date = DateTimeField()
+
+  #: The user's balance at #date.
+  balance = DecimalField(precision=2)
+
+  meta = {
+    'queryset_class': RoutedQuerySet,
+    'indexes': [{'fields': ['user', '-date'], 'unique': True}]
+  }
+
+  @classmethod
+  def get_nearest(cls, user, date=None):
+    """
+    Returns the latest checkpoint of *user* at or before *date*, or #None.
+    """
+
+    query = cls.objects(user=user)
+    if date is not None:
+      query = query.filter(date__lte=date)
+    return query.order_by('-date').first()
+
+
 class Request(Document):
   """
   Represents a request for money from another user.
   """
 
-  class Modes(enum.Enum):
-    OPEN = 1
-    REJECTED = 2
-    FULFILLED = 3
+  Modes = RequestMode
 
   #: The amount of money being requested.
   amount = DecimalField()
@@ -170,9 +437,15 @@ class Request(Document):
   #: A message for the request.
   description = StringField()
 
-  #: Whether the request is still open, has been fulfilled or rejected.
+  #: Whether the request is still open, has been fulfilled, rejected or
+  #: has expired.
   mode = EnumField(Modes)
 
+  meta = {
+    'queryset_class': RoutedQuerySet,
+    'indexes': [('mode', 'date')]
+  }
+
   def clean(self):
     if self.issuer == self.target and not config['settings']['allowSendToSelf']:
       raise ValidationError('Requests must have a different issuer and target.')
@@ -180,3 +453,389 @@ class Request(Document):
       raise ValidationError('Requests must have a positive amount.')
     if not self.date:
       self.date = datetime.now()
+
+
+class Notification(Document):
+  """
+  A message to a user other than the one that issued the current update
+  (eg. the receiver of a transaction). Notifications are written to this
+  outbox collection right next to the ledger change that caused them and
+  are delivered in the background by the #OutboxDispatcher.
+  """
+
+  class Modes(enum.Enum):
+    PENDING = 1
+    SENT = 2
+    FAILED = 3
+
+  #: The chat to send the message to.
+  chat_id = IntField()
+
+  #: The message text.
+  text = StringField()
+
+  #: Telegram parse mode of the #text, if any.
+  parse_mode = StringField()
+
+  #: JSON serialized reply markup of the message, if any.
+  reply_markup = StringField()
+
+  #: The date that the notification was created.
+  date = DateTimeField()
+
+  #: Whether the notification is still pending, has been sent or failed
+  #: permanently.
+  mode = EnumField(Modes)
+
+  #: The number of delivery attempts so far.
+  attempts = IntField(default=0)
+
+  #: The notification is not delivered before this date.
+  next_attempt = DateTimeField()
+
+  #: The error message of the last failed delivery attempt.
+  error = StringField()
+
+  meta = {
+    'indexes': [('mode', 'next_attempt')]
+  }
+
+  @classmethod
+  def create(cls, chat_id, text, parse_mode=None, reply_markup=None):
+    """
+    Creates a new pending notification. The *reply_markup* may be a
+    #telegram.ReplyMarkup object and will be serialized. The notification
+    must be saved by the caller.
+    """
+
+    if reply_markup is not None and not isinstance(reply_markup, str):
+      reply_markup = reply_markup.to_json()
+    now = datetime.now()
+    return cls(
+      chat_id=chat_id,
+      text=text,
+      parse_mode=parse_mode,
+      reply_markup=reply_markup,
+      date=now,
+      mode=cls.Modes.PENDING,
+      next_attempt=now
+    )
+
+  @classmethod
+  def save_all(cls, notifications):
+    """
+    Saves a list of new *notifications* with a single bulk insert.
+    """
+
+    if notifications:
+      cls.objects.insert(notifications, load_bulk=False)
+
+  @classmethod
+  def get_due(cls, limit):
+    """
+    Returns a query of at most *limit* pending notifications that are due
+    for delivery, oldest first.
+    """
+
+    query = cls.objects(mode=cls.Modes.PENDING, next_attempt__lte=datetime.now())
+    return query.order_by('next_attempt').limit(limit)
+
+
+class DailyRollup(Document):
+  """
+  Aggregates the transactions of a user on a single day. Rollups are
+  updated incrementally with every transaction and can be rebuilt from the
+  transaction history with #rebuild(). Summaries over a period only need to
+  read one document per day instead of every transaction.
+  """
+
+  #: The user that the rollup belongs to.
+  user = ReferenceField('User', reverse_delete_rule=DENY)
+
+  #: The day of the rollup (midnight, server's local time).
+  day = DateTimeField()
+
+  #: The total amount received on that day.
+  received = DecimalField(precision=2, default=0)
+
+  #: The number of transactions received on that day.
+  received_count = IntField(default=0)
+
+  #: The total amount sent on that day.
+  sent = DecimalField(precision=2, default=0)
+
+  #: The number of transactions sent on that day.
+  sent_count = IntField(default=0)
+
+  #: The users that the user sent money to or received money from.
+  counterparties = ListField(ReferenceField('User'))
+
+  meta = {
+    'queryset_class': RoutedQuerySet,
+    'indexes': [{'fields': ['user', 'day'], 'unique': True}]
+  }
+
+  @staticmethod
+  def _get_entries(transaction):
+    """
+    Yields a (user, direction, counterparty) tuple for every side of the
+    *transaction* that is to be counted in a rollup. Self-transactions are
+    skipped, just like in #User.compute_balance().
+    """
+
+    if transaction.sender == transaction.receiver:
+      return
+    if transaction.receiver:
+      yield transaction.receiver, 'received', transaction.sender
+    if transaction.sender:
+      yield transaction.sender, 'sent', transaction.receiver
+
+  @staticmethod
+  def get_day(date):
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+  @classmethod
+  def add_transaction(cls, transaction):
+    """
+    Adds a saved *transaction* to the rollups of its sender and receiver.
+    """
+
+    day = cls.get_day(transaction.date)
+    for user, direction, counterparty in cls._get_entries(transaction):
+      update = {
+        'inc__' + direction: transaction.amount,
+        'inc__' + direction + '_count': 1
+      }
+      if counterparty:
+        update['add_to_set__counterparties'] = counterparty
+      cls.objects(user=user, day=day).update_one(upsert=True, **update)
+
+  @classmethod
+  def rebuild(cls, *querysets, until=None, batch_size=1000):
+    """
+    Recomputes the rollups of all days before *until* (defaults to the start
+    of the current day) from the transactions in *querysets*. The rollups
+    are aggregated in memory and replaced one by one in batches, so that
+    readers never see a missing rollup. Rollups of these days that have no
+    transactions anymore are deleted afterwards.
+
+    The rollups from *until* onwards are left alone, as they are still
+    updated by #add_transaction(). Only pass a later *until* while no
+    transactions are written. Returns the number of rebuilt rollups.
+    """
+
+    if until is None:
+      until = cls.get_day(datetime.now())
+
+    rollups = collections.OrderedDict()
+    transactions = itertools.chain(*(
+      q.filter(date__lt=until).no_dereference() for q in querysets))
+
+    # A transaction may exist in both the hot and the archive collection if
+    # compaction was interrupted, make sure to count it only once.
+    seen = set()
+    for t in transactions:
+      if t.id in seen:
+        continue
+      seen.add(t.id)
+      day = cls.get_day(t.date)
+      for user, direction, counterparty in cls._get_entries(t):
+        key = (getattr(user, 'id', user), day)
+        rollup = rollups.get(key)
+        if rollup is None:
+          rollup = rollups[key] = cls(user=user, day=day, received=0, sent=0,
+            counterparties=[])
+        setattr(rollup, direction, getattr(rollup, direction) + t.amount)
+        setattr(rollup, direction + '_count', getattr(rollup, direction + '_count') + 1)
+        if counterparty and counterparty not in rollup.counterparties:
+          rollup.counterparties.append(counterparty)
+
+    cls.ensure_indexes()
+    collection = cls._get_collection()
+    batch = []
+    for (user_id, day), rollup in rollups.items():
+      batch.append(ReplaceOne({'user': user_id, 'day': day}, rollup.to_mongo(), upsert=True))
+      if len(batch) >= batch_size:
+        collection.bulk_write(batch, ordered=False)
+        batch = []
+    if batch:
+      collection.bulk_write(batch, ordered=False)
+
+    stale = [son['_id'] for son in cls.objects(day__lt=until).only('user', 'day').as_pymongo()
+      if (son.get('user'), son.get('day')) not in rollups]
+    for offset in range(0, len(stale), batch_size):
+      cls.objects(id__in=stale[offset:offset + batch_size]).delete()
+    return len(rollups)
+
+  @classmethod
+  def summarize(cls, user, start, end):
+    """
+    Returns a #Summary of the rollups of *user* for the days between *start*
+    (inclusive) and *end* (exclusive). The number of counterparties is the
+    number of distinct users over the whole period.
+    """
+
+    query = cls.objects(user=user, day__gte=start, day__lt=end).no_dereference()
+    received, received_count = Decimal(), 0
+    sent, sent_count = Decimal(), 0
+    counterparties = set()
+    for rollup in query:
+      received += rollup.received
+      received_count += rollup.received_count
+      sent += rollup.sent
+      sent_count += rollup.sent_count
+      counterparties.update(getattr(x, 'id', x) for x in rollup.counterparties)
+    return Summary(received, received_count, sent, sent_count, len(counterparties))
+
+
+class MongoStorage(Storage):
+  """
+  #Storage implementation on top of the MongoEngine documents. MongoDB
+  offers no row-level locks, the sender's balance is checked against the
+  cached #User.balance.
+  """
+
+  def get_user(self, telegram_id):
+    return User.objects(telegram_id=telegram_id).first()
+
+  def find_user(self, username):
+    return User.objects(username__iexact=username).first()
+
+  def find_users(self, usernames):
+    patterns = [re.compile('^{}$'.format(re.escape(x)), re.IGNORECASE) for x in usernames]
+    query = User.objects(__raw__={'username': {'$in': patterns}})
+    return {user.username.lower(): user for user in query}
+
+  def get_user_refs(self, user_ids):
+    query = User.objects(id__in=list(user_ids))
+    query = query.only('chat_id', 'telegram_id', 'username').as_pymongo()
+    return {u['_id']: UserRef(u['_id'], u.get('chat_id'), u.get('telegram_id'),
+      u.get('username')) for u in query}
+
+  def create_user(self, chat_id, telegram_id, username, name, language_code):
+    user = User(
+      chat_id=chat_id,
+      telegram_id=telegram_id,
+      username=username,
+      name=name,
+      language_code=language_code,
+      balance=Decimal()
+    )
+    user.save()
+    return user
+
+  def append_transaction(self, receiver, amount, sender=None, provider=None,
+                         description=None):
+    if sender is not None:
+      check_amount(amount)
+      if amount > sender.balance:
+        raise InsufficientFunds(sender.balance)
+
+    details = None
+    if provider is not None:
+      details = GatewayTransactionDetails(provider=provider)
+      # FIXME: Two-phase transaction to ensure either both objects are saved
+      #        or none!
+      details.save()
+
+    transaction = Transaction(
+      amount=amount,
+      receiver=receiver,
+      sender=sender,
+      gateway_details=details,
+      description=description
+    )
+    transaction.save()
+    DailyRollup.add_transaction(transaction)
+
+    receiver.update_balance()
+    if sender is not None and sender.id != receiver.id:
+      sender.update_balance()
+    return transaction
+
+  def get_balance(self, user):
+    son = User.objects(id=user.id).only('balance').as_pymongo().first()
+    if son is None or son.get('balance') is None:
+      return Decimal()
+    return User.balance.to_python(son['balance'])
+
+  def get_transactions(self, user):
+    query = user.get_transactions().order_by('date').only('amount', 'date',
+      'sender', 'receiver', 'gateway_details', 'description')
+    transactions = list(query.as_pymongo())
+
+    # Resolve the payment providers with a single query.
+    details_ids = set(t['gateway_details'] for t in transactions if t.get('gateway_details'))
+    providers = {}
+    if details_ids:
+      query = GatewayTransactionDetails.objects(id__in=list(details_ids))
+      providers = {d['_id']: d.get('provider') for d in query.only('provider').as_pymongo()}
+
+    return [to_ledger_row(t, providers) for t in transactions]
+
+  def get_summary(self, user, start, end):
+    return DailyRollup.summarize(user, start, end)
+
+  def create_request(self, issuer, target, amount, description=None):
+    check_amount(amount)
+    request = Request(
+      issuer=issuer,
+      target=target,
+      amount=amount,
+      description=description,
+      mode=Request.Modes.OPEN
+    )
+    request.save()
+    return request
+
+  def create_requests(self, issuer, targets, amount, description=None):
+    check_amount(amount)
+    requests = []
+    for target in targets:
+      request = Request(
+        issuer=issuer,
+        target=target,
+        amount=amount,
+        description=description,
+        mode=Request.Modes.OPEN
+      )
+      request.validate()
+      requests.append(request)
+    ids = Request.objects.insert(requests, load_bulk=False)
+    for request, request_id in zip(requests, ids):
+      request.id = request_id
+    return requests
+
+  def get_request(self, request_id):
+    try:
+      query = Request.objects(id=request_id).as_pymongo()
+      son = query.only('amount', 'date', 'mode', 'issuer', 'target', 'description').first()
+    except ValidationError:
+      # Not a valid ObjectId.
+      return None
+    if son is None:
+      return None
+    return RequestRow(
+      son['_id'],
+      Request.amount.to_python(son['amount']),
+      son.get('date'),
+      RequestMode(son['mode']),
+      son.get('issuer'),
+      son.get('target'),
+      son.get('description')
+    )
+
+  def expire_requests(self, before, limit):
+    query = Request.objects(mode=RequestMode.OPEN, date__lt=before)
+    ids = [r['_id'] for r in query.order_by('date').limit(limit).only('id').as_pymongo()]
+    if not ids:
+      return []
+    Request.objects(id__in=ids, mode=RequestMode.OPEN).update(set__mode=RequestMode.EXPIRED)
+    # Requests that have been answered in the meantime were not updated.
+    return list(Request.objects(id__in=ids, mode=RequestMode.EXPIRED).select_related())
+
+  def set_request_mode(self, request, mode, expected=RequestMode.OPEN):
+    updated = Request.objects(id=request.id, mode=expected).update_one(set__mode=mode)
+    if not updated:
+      raise RequestStateError(request.id, expected)
+    request.mode = mode
@@ -0,0 +1,135 @@
+
+import collections
+import decimal
+import random
+import time
+import uuid
+
+import {InsufficientFunds, RequestMode} from './storage'
+
+
+def benchmark_storage(storage, users=100, operations=2000, seed=0):
+  """
+  Runs a random mix of the operations of a #Storage that the bot's handlers
+  use and measures their latency. The benchmark creates *users* new users
+  and performs *operations* operations between them. Returns a dictionary
+  that maps every operation name to a sorted list of latencies in seconds.
+  """
+
+  rand = random.Random(seed)
+  timings = collections.OrderedDict()
+
+  def timed(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      timings.setdefault(name, []).append(time.perf_counter() - start)
+
+  # Use unique names and negative Telegram IDs so that the benchmark does
+  # not collide with real users or previous runs.
+  run_id = uuid.uuid4().hex[:8]
+  base_id = -rand.randrange(1, 2 ** 40)
+  population = []
+  for i in range(users):
+    name = 'bench_{}_{}'.format(run_id, i)
+    user = timed('create_user', storage.create_user,
+      base_id - i, base_id - i, name, name, 'en')
+    timed('append_transaction', storage.append_transaction, user,
+      decimal.Decimal(1000), provider='benchmark')
+    population.append(user)
+
+  for _ in range(operations):
+    op = rand.random()
+    sender, receiver = rand.sample(population, 2)
+    if op < 0.3:
+      timed('get_user', storage.get_user, sender.telegram_id)
+    elif op < 0.4:
+      timed('find_user', storage.find_user, receiver.username.upper())
+    elif op < 0.7:
+      timed('get_balance', storage.get_balance, sender)
+    elif op < 0.9:
+      amount = decimal.Decimal(rand.randint(1, 500)) / 100
+      try:
+        timed('append_transaction', storage.append_transaction, receiver,
+          amount, sender=sender, description='benchmark')
+      except InsufficientFunds:
+        pass
+    else:
+      request = timed('create_request', storage.create_request, sender,
+        receiver, decimal.Decimal(1), 'benchmark')
+      timed('set_request_mode', storage.set_request_mode, request,
+        RequestMode.REJECTED)
+
+  for values in timings.values():
+    values.sort()
+  return timings
+
+
+def benchmark_reads(db, rows=10000, seed=0):
+  """
+  Compares building full #db.Transaction documents with building projected
+  #LedgerRow records from the same raw MongoDB documents, as the
+  transaction history does. Dereferencing is disabled for the documents,
+  in practice every accessed reference costs an additional query.
+
+  Returns a dictionary that maps the name of the read path to a tuple of
+  the CPU seconds, the retained bytes and the retained memory blocks, each
+  per row.
+  """
+
+  import tracemalloc
+  from bson import ObjectId
+  from datetime import datetime, timedelta
+  from mongoengine.context_managers import no_dereference
+
+  rand = random.Random(seed)
+  users = [ObjectId() for _ in range(100)]
+  now = datetime.now()
+  sons = []
+  for i in range(rows):
+    sender, receiver = rand.sample(users, 2)
+    sons.append({
+      '_id': ObjectId(),
+      'amount': rand.randint(1, 100000) / 100.0,
+      'date': now - timedelta(minutes=i),
+      'sender': sender,
+      'receiver': receiver,
+      'description': 'benchmark'
+    })
+
+  def full():
+    with no_dereference(db.Transaction):
+      result = []
+      for son in sons:
+        t = db.Transaction._from_son(son)
+        t.amount, t.date, t.sender, t.receiver, t.description
+        result.append(t)
+      return result
+
+  def projected():
+    result = []
+    for son in sons:
+      t = db.to_ledger_row(son, {})
+      t.amount, t.date, t.sender_id, t.receiver_id, t.description
+      result.append(t)
+    return result
+
+  results = collections.OrderedDict()
+  for name, func in [('documents', full), ('records', projected)]:
+    start = time.process_time()
+    func()
+    cpu = time.process_time() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(x.size_diff for x in stats)
+    blocks = sum(x.count_diff for x in stats)
+    del result
+
+    results[name] = (cpu / rows, size / rows, blocks / rows)
+  return results
@@ -0,0 +1,301 @@
+
+from datetime import datetime
+from sqlalchemy import (
+  BigInteger, Column, DateTime, Enum, ForeignKey, Index, Integer, Numeric,
+  String, Text, create_engine, event, func, or_, union
+)
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+
+import contextlib
+import decimal
+
+import {
+  Storage, Summary, RequestMode,
+  UserRef, LedgerRow, RequestRow,
+  InsufficientFunds, RequestStateError, check_amount
+} from './storage'
+
+Base = declarative_base()
+
+
+class User(Base):
+  __tablename__ = 'users'
+
+  id = Column(Integer, primary_key=True)
+  chat_id = Column(BigInteger, unique=True)
+  telegram_id = Column(BigInteger, unique=True, nullable=False)
+  username = Column(String(64), unique=True)
+  name = Column(String(256))
+  language_code = Column(String(16))
+
+  #: The user's current balance, updated in the same database transaction
+  #: as every #LedgerEntry of the user.
+  balance = Column(Numeric(12, 2), nullable=False, default=0)
+
+  __table_args__ = (
+    Index('ix_users_username_lower', func.lower(username)),
+  )
+
+
+class LedgerEntry(Base):
+  """
+  A transaction between users or between a user and a payment gateway,
+  see #db.Transaction.
+  """
+
+  __tablename__ = 'ledger'
+
+  id = Column(Integer, primary_key=True)
+  amount = Column(Numeric(12, 2), nullable=False)
+  date = Column(DateTime, nullable=False, default=datetime.now)
+  receiver_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+  sender_id = Column(Integer, ForeignKey('users.id'))
+  provider = Column(String(64))
+  description = Column(Text)
+
+  receiver = relationship(User, foreign_keys=[receiver_id], lazy='joined')
+  sender = relationship(User, foreign_keys=[sender_id], lazy='joined')
+
+  __table_args__ = (
+    Index('ix_ledger_receiver_date', receiver_id, date),
+    Index('ix_ledger_sender_date', sender_id, date),
+  )
+
+
+class Request(Base):
+  """
+  A request for money from another user, see #db.Request.
+  """
+
+  __tablename__ = 'requests'
+
+  Modes = RequestMode
+
+  id = Column(Integer, primary_key=True)
+  amount = Column(Numeric(12, 2), nullable=False)
+  date = Column(DateTime, nullable=False, default=datetime.now)
+  issuer_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+  target_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+  description = Column(Text)
+  mode = Column(Enum(RequestMode), nullable=False)
+
+  issuer = relationship(User, foreign_keys=[issuer_id], lazy='joined')
+  target = relationship(User, foreign_keys=[target_id], lazy='joined')
+
+  __table_args__ = (
+    Index('ix_requests_issuer_mode', issuer_id, mode),
+    Index('ix_requests_target_mode', target_id, mode),
+    Index('ix_requests_mode_date', mode, date),
+  )
+
+
+class SqlStorage(Storage):
+  """
+  #Storage implementation on top of SQLAlchemy. Appending to the ledger
+  locks the rows of the involved users (`SELECT ... FOR UPDATE`) so that
+  concurrent transfers can not overdraw the sender's balance. SQLite has
+  no row-level locks, so write transactions are started with
+  `BEGIN IMMEDIATE` instead, which serializes all writers. Reads use a
+  plain deferred `BEGIN` and do not wait for writers.
+  """
+
+  def __init__(self, url, **engine_options):
+    self.engine = create_engine(url, **engine_options)
+    if self.engine.dialect.name == 'sqlite':
+      self._use_immediate_transactions(self.engine)
+    Base.metadata.create_all(self.engine)
+    self._sessionmaker = sessionmaker(bind=self.engine, expire_on_commit=False)
+
+  @staticmethod
+  def _use_immediate_transactions(engine):
+    # See "Serializable isolation / Savepoints / Transactional DDL" in the
+    # SQLAlchemy SQLite dialect documentation.
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+      dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+      if connection.get_execution_options().get('sqlite_immediate'):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+      else:
+        connection.exec_driver_sql('BEGIN')
+
+  @contextlib.contextmanager
+  def session(self, write=False):
+    """
+    Context manager for a session whose transaction is committed when the
+    context exits normally and rolled back otherwise. Pass *write* for
+    transactions that read data in order to change it, which takes the
+    write lock up front on SQLite.
+    """
+
+    session = self._sessionmaker()
+    try:
+      if write:
+        session.connection(execution_options={'sqlite_immediate': True})
+      yield session
+      session.commit()
+    except BaseException:
+      session.rollback()
+      raise
+    finally:
+      session.close()
+
+  def get_user(self, telegram_id):
+    with self.session() as session:
+      return session.query(User).filter(User.telegram_id == telegram_id).first()
+
+  def find_user(self, username):
+    with self.session() as session:
+      query = session.query(User).filter(func.lower(User.username) == username.lower())
+      return query.first()
+
+  def find_users(self, usernames):
+    with self.session() as session:
+      names = [x.lower() for x in usernames]
+      query = session.query(User).filter(func.lower(User.username).in_(names))
+      return {user.username.lower(): user for user in query}
+
+  def get_user_refs(self, user_ids):
+    with self.session() as session:
+      query = session.query(User.id, User.chat_id, User.telegram_id, User.username)
+      return {row.id: UserRef(*row) for row in query.filter(User.id.in_(list(user_ids)))}
+
+  def create_user(self, chat_id, telegram_id, username, name, language_code):
+    user = User(
+      chat_id=chat_id,
+      telegram_id=telegram_id,
+      username=username,
+      name=name,
+      language_code=language_code,
+      balance=decimal.Decimal()
+    )
+    with self.session() as session:
+      session.add(user)
+    return user
+
+  def append_transaction(self, receiver, amount, sender=None, provider=None,
+                         description=None):
+    if sender is not None:
+      check_amount(amount)
+    with self.session(write=True) as session:
+      # Lock the rows of both parties in a consistent order to avoid
+      # deadlocks between concurrent transfers.
+      ids = sorted(set(u.id for u in (receiver, sender) if u is not None))
+      query = session.query(User).filter(User.id.in_(ids)).order_by(User.id)
+      users = {u.id: u for u in query.with_for_update()}
+
+      if sender is not None and amount > users[sender.id].balance:
+        raise InsufficientFunds(users[sender.id].balance)
+
+      entry = LedgerEntry(
+        amount=amount,
+        date=datetime.now(),
+        receiver=users[receiver.id],
+        sender=users[sender.id] if sender is not None else None,
+        provider=provider,
+        description=description
+      )
+      session.add(entry)
+
+      # Self-transactions are not counted in the balance, see
+      # #db.User.compute_balance().
+      if sender is None or sender.id != receiver.id:
+        users[receiver.id].balance += amount
+        if sender is not None:
+          users[sender.id].balance -= amount
+
+    receiver.balance = users[receiver.id].balance
+    if sender is not None:
+      sender.balance = users[sender.id].balance
+    return entry
+
+  def get_balance(self, user):
+    with self.session() as session:
+      return session.query(User.balance).filter(User.id == user.id).scalar()
+
+  def get_transactions(self, user):
+    with self.session() as session:
+      query = session.query(LedgerEntry.id, LedgerEntry.amount, LedgerEntry.date,
+        LedgerEntry.sender_id, LedgerEntry.receiver_id, LedgerEntry.provider,
+        LedgerEntry.description)
+      query = query.filter(or_(
+        LedgerEntry.receiver_id == user.id, LedgerEntry.sender_id == user.id))
+      return [LedgerRow(*row) for row in query.order_by(LedgerEntry.date)]
+
+  def get_summary(self, user, start, end):
+    in_period = [LedgerEntry.date >= start, LedgerEntry.date < end]
+    received = [LedgerEntry.receiver_id == user.id, or_(
+      LedgerEntry.sender_id == None, LedgerEntry.sender_id != user.id)]
+    sent = [LedgerEntry.sender_id == user.id, LedgerEntry.receiver_id != user.id]
+    totals = [func.coalesce(func.sum(LedgerEntry.amount), 0), func.count(LedgerEntry.id)]
+
+    with self.session() as session:
+      received_total, received_count = session.query(*totals).filter(
+        *(in_period + received)).one()
+      sent_total, sent_count = session.query(*totals).filter(
+        *(in_period + sent)).one()
+      counterparties = union(
+        session.query(LedgerEntry.sender_id.label('user_id'))
+          .filter(*(in_period + received + [LedgerEntry.sender_id != None])),
+        session.query(LedgerEntry.receiver_id.label('user_id'))
+          .filter(*(in_period + sent))
+      ).subquery()
+      counterparty_count = session.query(func.count()).select_from(counterparties).scalar()
+
+    return Summary(decimal.Decimal(received_total), received_count,
+      decimal.Decimal(sent_total), sent_count, counterparty_count)
+
+  def create_request(self, issuer, target, amount, description=None):
+    return self.create_requests(issuer, [target], amount, description)[0]
+
+  def create_requests(self, issuer, targets, amount, description=None):
+    check_amount(amount)
+    date = datetime.now()
+    with self.session(write=True) as session:
+      ids = set([issuer.id] + [target.id for target in targets])
+      users = {u.id: u for u in session.query(User).filter(User.id.in_(ids))}
+      requests = [Request(
+        issuer=users[issuer.id],
+        target=users[target.id],
+        amount=amount,
+        description=description,
+        mode=RequestMode.OPEN,
+        date=date
+      ) for target in targets]
+      session.add_all(requests)
+    return requests
+
+  def get_request(self, request_id):
+    try:
+      request_id = int(request_id)
+    except ValueError:
+      return None
+    with self.session() as session:
+      query = session.query(Request.id, Request.amount, Request.date, Request.mode,
+        Request.issuer_id, Request.target_id, Request.description)
+      row = query.filter(Request.id == request_id).first()
+    return RequestRow(*row) if row else None
+
+  def expire_requests(self, before, limit):
+    with self.session(write=True) as session:
+      query = session.query(Request).filter(
+        Request.mode == RequestMode.OPEN, Request.date < before)
+      query = query.order_by(Request.date).limit(limit).with_for_update(of=Request)
+      requests = query.all()
+      if requests:
+        update = session.query(Request).filter(Request.id.in_([r.id for r in requests]))
+        update.update({Request.mode: RequestMode.EXPIRED}, synchronize_session=False)
+    for request in requests:
+      request.mode = RequestMode.EXPIRED
+    return requests
+
+  def set_request_mode(self, request, mode, expected=RequestMode.OPEN):
+    with self.session(write=True) as session:
+      query = session.query(Request).filter(
+        Request.id == request.id, Request.mode == expected)
+      updated = query.update({Request.mode: mode}, synchronize_session=False)
+    if not updated:
+      raise RequestStateError(request.id, expected)
+    request.mode = mode
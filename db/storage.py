@@ -0,0 +1,207 @@
+
+import abc
+import collections
+import enum
+
+
+#: Summary of a user's transactions over a period of time.
+Summary = collections.namedtuple('Summary',
+  'received received_count sent sent_count counterparties')
+
+
+class RequestMode(enum.Enum):
+  OPEN = 1
+  REJECTED = 2
+  FULFILLED = 3
+  EXPIRED = 4
+
+
+class Record(object):
+  """
+  Base class for compact, read-only records of the few fields that a read
+  path needs. Records are much cheaper to create than full documents or ORM
+  objects. References to other objects are kept as ids.
+  """
+
+  __slots__ = ()
+
+  def __init__(self, *values):
+    for name, value in zip(self.__slots__, values):
+      setattr(self, name, value)
+
+  def __repr__(self):
+    fields = ', '.join('{}={!r}'.format(x, getattr(self, x)) for x in self.__slots__)
+    return '{}({})'.format(type(self).__name__, fields)
+
+
+class UserRef(Record):
+  __slots__ = ('id', 'chat_id', 'telegram_id', 'username')
+
+
+class LedgerRow(Record):
+  __slots__ = ('id', 'amount', 'date', 'sender_id', 'receiver_id', 'provider', 'description')
+
+
+class RequestRow(Record):
+  __slots__ = ('id', 'amount', 'date', 'mode', 'issuer_id', 'target_id', 'description')
+
+  Modes = RequestMode
+
+
+class StorageError(Exception):
+  pass
+
+
+class InsufficientFunds(StorageError):
+  """
+  Raised by #Storage.append_transaction() if the sender's balance does not
+  cover the amount of the transaction.
+  """
+
+  def __init__(self, balance):
+    super().__init__(balance)
+    self.balance = balance
+
+
+class InvalidAmount(StorageError):
+  """
+  Raised if the amount of a transfer between users or of a request is not
+  positive.
+  """
+
+  def __init__(self, amount):
+    super().__init__(amount)
+    self.amount = amount
+
+
+def check_amount(amount):
+  """
+  Raises #InvalidAmount if *amount* is not positive.
+  """
+
+  if amount <= 0:
+    raise InvalidAmount(amount)
+
+
+class RequestStateError(StorageError):
+  """
+  Raised by #Storage.set_request_mode() if the request is not in the
+  expected mode (anymore).
+  """
+
+
+class Storage(metaclass=abc.ABCMeta):
+  """
+  Interface for the storage operations of the bot's handlers. Users,
+  transactions and requests returned by a storage provide the same
+  attributes as the MongoEngine documents in this package (eg. a user
+  has an `id`, `chat_id`, `telegram_id`, `username` and `balance`), but
+  they must be compared by their `id`. Hot read paths return #Record#s
+  instead.
+  """
+
+  @abc.abstractmethod
+  def get_user(self, telegram_id):
+    """
+    Returns the user with the specified Telegram user ID, or #None.
+    """
+
+  @abc.abstractmethod
+  def find_user(self, username):
+    """
+    Returns the user with the specified *username* (case-insensitive), or
+    #None.
+    """
+
+  @abc.abstractmethod
+  def find_users(self, usernames):
+    """
+    Looks up all *usernames* (case-insensitive) in a single query. Returns
+    a dictionary that maps the lowercase username to the user. Usernames
+    that could not be found are missing from the dictionary.
+    """
+
+  @abc.abstractmethod
+  def get_user_refs(self, user_ids):
+    """
+    Returns a dictionary that maps the specified user IDs to #UserRef
+    records, read with a single query.
+    """
+
+  @abc.abstractmethod
+  def create_user(self, chat_id, telegram_id, username, name, language_code):
+    """
+    Creates and returns a new user with a balance of zero.
+    """
+
+  @abc.abstractmethod
+  def append_transaction(self, receiver, amount, sender=None, provider=None,
+                         description=None):
+    """
+    Appends a transaction of *amount* from *sender* to *receiver* to the
+    ledger and updates the cached balances of both (including the
+    `balance` attribute of the passed user objects). If there is no
+    *sender*, the *provider* names the payment gateway that credited the
+    amount. Raises #InvalidAmount if there is a *sender* and the amount is
+    not positive, and #InsufficientFunds if the sender's balance does not
+    cover the amount. Returns the new transaction.
+    """
+
+  @abc.abstractmethod
+  def get_balance(self, user):
+    """
+    Returns the current balance of *user*, as cached by
+    #append_transaction().
+    """
+
+  @abc.abstractmethod
+  def get_transactions(self, user):
+    """
+    Returns a list of #LedgerRow#s for all transactions that *user*
+    participates in as a receiver or sender, oldest first.
+    """
+
+  @abc.abstractmethod
+  def get_summary(self, user, start, end):
+    """
+    Returns a #Summary of the transactions of *user* from *start*
+    (inclusive) to *end* (exclusive).
+    """
+
+  @abc.abstractmethod
+  def create_request(self, issuer, target, amount, description=None):
+    """
+    Creates and returns a new open request for *amount* from *issuer* to
+    *target*. Raises #InvalidAmount if the amount is not positive.
+    """
+
+  @abc.abstractmethod
+  def create_requests(self, issuer, targets, amount, description=None):
+    """
+    Creates an open request for *amount* from *issuer* to every user in
+    *targets* with a single bulk insert. Raises #InvalidAmount if the
+    amount is not positive. Returns the list of requests in the order of
+    *targets*.
+    """
+
+  @abc.abstractmethod
+  def get_request(self, request_id):
+    """
+    Returns a #RequestRow for the request with the specified ID, or #None.
+    """
+
+  @abc.abstractmethod
+  def expire_requests(self, before, limit):
+    """
+    Changes the mode of up to *limit* open requests that were issued before
+    *before* to #RequestMode.EXPIRED with a single bulk update, oldest
+    first. Returns the list of expired requests.
+    """
+
+  @abc.abstractmethod
+  def set_request_mode(self, request, mode, expected=RequestMode.OPEN):
+    """
+    Changes the mode of *request* to *mode* if it is still in the
+    *expected* mode, otherwise raises a #RequestStateError. The check and
+    the change are performed atomically.
+    """
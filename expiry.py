@@ -0,0 +1,72 @@
+
+from datetime import datetime, timedelta
+
+import collections
+
+import db from './db'
+import {Worker} from './base/worker'
+
+
+class RequestSweeper(Worker):
+  """
+  Expires open requests that are older than *expire_after* in batches of
+  *batch_size*. Every issuer receives a single summary notification per
+  batch instead of one message per expired request. Summaries that would
+  exceed Telegram's message length limit only list the first requests.
+  """
+
+  #: Maximum length of a Telegram message.
+  MAX_MESSAGE_LENGTH = 4096
+
+  def __init__(self, storage, expire_after, interval=3600.0, batch_size=500):
+    super().__init__('RequestSweeper', interval)
+    self.storage = storage
+    self.expire_after = expire_after
+    self.batch_size = batch_size
+
+  @classmethod
+  def from_config(cls, storage, config):
+    """
+    Returns a #RequestSweeper for the `requests` section of the
+    configuration, or #None if requests do not expire.
+    """
+
+    days = config.get('expireAfterDays')
+    if not days:
+      return None
+    return cls(
+      storage,
+      timedelta(days=days),
+      interval=config.get('sweepInterval', 3600.0),
+      batch_size=config.get('sweepBatchSize', 500)
+    )
+
+  def run_once(self):
+    before = datetime.now() - self.expire_after
+    expired = self.storage.expire_requests(before, self.batch_size)
+    if expired:
+      self.logger.info('Expired %d requests.', len(expired))
+      db.Notification.save_all(self.create_notifications(expired))
+    return len(expired) == self.batch_size
+
+  def create_notifications(self, requests):
+    by_issuer = collections.OrderedDict()
+    for request in requests:
+      by_issuer.setdefault(request.issuer.id, []).append(request)
+
+    notifications = []
+    for requests in by_issuer.values():
+      lines = ['{} of your requests expired:'.format(len(requests))]
+      more = '\n... and {} more.'.format(len(requests))
+      length = len(lines[0]) + len(more)
+      for index, request in enumerate(requests):
+        line = '{} from @{} ({})'.format(request.amount,
+          request.target.username, request.date.strftime('%Y-%m-%d'))
+        length += len(line) + 1
+        if length > self.MAX_MESSAGE_LENGTH:
+          lines.append('... and {} more.'.format(len(requests) - index))
+          break
+        lines.append(line)
+      notifications.append(db.Notification.create(
+        requests[0].issuer.chat_id, '\n'.join(lines)))
+    return notifications
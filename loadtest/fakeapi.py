@@ -0,0 +1,304 @@
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+import collections
+import json
+import random
+import threading
+import time
+
+import {Middleware, g, update} from '../base/app'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class FakeBotApi(object):
+  """
+  A local stand-in for the Telegram Bot API. It serves `getUpdates` from a
+  queue of simulated updates and records the bot's replies, so that the
+  complete stack (#telegram.ext.Updater polling, the #Application, the
+  database and outgoing messages) can be driven without network access.
+
+  The bot must report every handled update with #finish(), see
+  #FinishMiddleware. Updates of a chat are handled in order, so a
+  `sendMessage` to a chat belongs to the oldest unfinished update of that
+  chat. When an update is finished, it is counted as
+
+  * `shed` if the admission controller dropped it (whether or not a notice
+    was sent),
+  * `failed` if the handler raised an exception (the traceback that is
+    sent in debug mode is not a reply) or a `sendMessage` for it was
+    answered with a 429 error,
+  * `replied` if it was answered, in which case the latency from the
+    creation of the update to the first reply is recorded,
+  * `unanswered` otherwise.
+
+  Messages to chats without an unfinished update (eg. notifications sent by
+  the outbox) are counted as `unsolicited`. Each response can be delayed
+  by *latency* seconds, and a fraction of *error_rate* of the outgoing
+  calls is answered with a 429 (Too Many Requests) error.
+  """
+
+  def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+               retry_after=1, seed=0):
+    self.latency = latency
+    self.error_rate = error_rate
+    self.retry_after = retry_after
+    self.random = random.Random(seed)
+    self.server = ThreadingHTTPServer((host, port), self._make_handler())
+    self._thread = None
+    self._lock = threading.Condition()
+    self._updates = collections.deque()
+    self._next_update_id = 1
+    self._next_message_id = 1
+    self._unfinished = {}
+    self._unfinished_by_chat = collections.defaultdict(collections.deque)
+    self.reset_stats()
+
+  @property
+  def base_url(self):
+    """
+    The URL to pass as *base_url* to the #telegram.Bot.
+    """
+
+    return 'http://{}:{}/bot'.format(*self.server.server_address[:2])
+
+  def start(self):
+    self._thread = threading.Thread(target=self.server.serve_forever,
+      name='FakeBotApi', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def reset_stats(self):
+    with self._lock:
+      self.latencies = []
+      self.counters = collections.Counter()
+
+  def stats(self):
+    """
+    Returns a copy of the counters and the sorted list of latencies of the
+    replied updates. The `pending` counter is the number of updates that
+    have not been finished.
+    """
+
+    with self._lock:
+      counters = collections.Counter(self.counters)
+      counters['pending'] = len(self._unfinished)
+      return counters, sorted(self.latencies)
+
+  def push_message(self, chat_id, text):
+    """
+    Queues an update with a private message from the user *chat_id*.
+    """
+
+    with self._lock:
+      update_id = self._next_update_id
+      self._next_update_id += 1
+      self._updates.append({
+        'update_id': update_id,
+        'message': {
+          'message_id': update_id,
+          'date': int(time.time()),
+          'chat': {'id': chat_id, 'type': 'private'},
+          'from': {
+            'id': chat_id,
+            'is_bot': False,
+            'first_name': 'Load',
+            'last_name': str(chat_id),
+            'username': 'loadtest_{}'.format(chat_id)
+          },
+          'text': text
+        }
+      })
+      self._unfinished[update_id] = {'created': time.perf_counter(),
+        'chat_id': chat_id, 'replied': None, 'throttled': False}
+      self._unfinished_by_chat[chat_id].append(update_id)
+      self.counters['updates'] += 1
+      self._lock.notify_all()
+
+  def feed(self, chat_ids, text, count, rate):
+    """
+    Pushes *count* messages with the specified *text* from randomly chosen
+    *chat_ids* at a rate of *rate* messages per second. Blocks until all
+    messages have been pushed.
+    """
+
+    start = time.perf_counter()
+    for i in range(count):
+      delay = start + i / rate - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      self.push_message(self.random.choice(chat_ids), text)
+
+  def finish(self, update_id, shed=False, failed=False):
+    """
+    Called by the bot after it handled the update with the specified ID.
+    """
+
+    with self._lock:
+      record = self._unfinished.pop(update_id, None)
+      if record is None:
+        return
+      self._unfinished_by_chat[record['chat_id']].remove(update_id)
+      if not self._unfinished_by_chat[record['chat_id']]:
+        del self._unfinished_by_chat[record['chat_id']]
+      if shed:
+        self.counters['shed'] += 1
+      elif failed or record['throttled']:
+        self.counters['failed'] += 1
+      elif record['replied'] is not None:
+        self.counters['replied'] += 1
+        self.latencies.append(record['replied'] - record['created'])
+      else:
+        self.counters['unanswered'] += 1
+      self._lock.notify_all()
+
+  def wait(self, timeout):
+    """
+    Waits until all updates have been finished or *timeout* seconds have
+    passed. Returns #True if all updates have been finished.
+    """
+
+    deadline = time.perf_counter() + timeout
+    with self._lock:
+      while self._unfinished:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+          return False
+        self._lock.wait(remaining)
+    return True
+
+  def get_updates(self, params):
+    offset = int(params.get('offset') or 0)
+    limit = int(params.get('limit') or 100)
+    timeout = float(params.get('timeout') or 0)
+    deadline = time.perf_counter() + timeout
+    with self._lock:
+      while self._updates and self._updates[0]['update_id'] < offset:
+        self._updates.popleft()
+      while not self._updates:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+          break
+        self._lock.wait(remaining)
+      return [self._updates[i] for i in range(min(limit, len(self._updates)))]
+
+  def _get_current(self, chat_id):
+    # Returns the record of the update of *chat_id* that is being handled.
+    # Must be called with the lock held.
+    update_ids = self._unfinished_by_chat.get(chat_id)
+    return self._unfinished[update_ids[0]] if update_ids else None
+
+  def send_message(self, params):
+    chat_id = int(params['chat_id'])
+    with self._lock:
+      message_id = self._next_message_id
+      self._next_message_id += 1
+      self.counters['sendMessage'] += 1
+      record = self._get_current(chat_id)
+      if record is None:
+        self.counters['unsolicited'] += 1
+      elif record['replied'] is None:
+        record['replied'] = time.perf_counter()
+    return {
+      'message_id': message_id,
+      'date': int(time.time()),
+      'chat': {'id': chat_id, 'type': 'private'},
+      'text': params.get('text', '')
+    }
+
+  def handle(self, method, params):
+    """
+    Handles a call to the Bot API *method* and returns a tuple of the HTTP
+    status and the response payload.
+    """
+
+    if self.latency:
+      time.sleep(self.latency)
+    if method in ('sendMessage', 'sendChatAction', 'answerCallbackQuery'):
+      with self._lock:
+        self.counters[method + '_calls'] += 1
+        throttled = self.random.random() < self.error_rate
+        if throttled:
+          self.counters['429'] += 1
+          record = None
+          if method == 'sendMessage' and 'chat_id' in params:
+            record = self._get_current(int(params['chat_id']))
+          if record is not None:
+            record['throttled'] = True
+      if throttled:
+        return 429, {
+          'ok': False,
+          'error_code': 429,
+          'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+          'parameters': {'retry_after': self.retry_after}
+        }
+
+    if method == 'getUpdates':
+      result = self.get_updates(params)
+    elif method == 'sendMessage':
+      result = self.send_message(params)
+    elif method == 'getMe':
+      result = {'id': 1, 'is_bot': True, 'first_name': 'KwittBot', 'username': 'KwittBot'}
+    else:
+      # sendChatAction, answerCallbackQuery, deleteWebhook, setWebhook, ...
+      result = True
+    return 200, {'ok': True, 'result': result}
+
+  def _make_handler(self):
+    api = self
+
+    class Handler(BaseHTTPRequestHandler):
+
+      def do_GET(self):
+        self.do_POST()
+
+      def do_POST(self):
+        url = urlparse(self.path)
+        method = url.path.rpartition('/')[2]
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+          body = self.rfile.read(length).decode('utf8')
+          if 'json' in (self.headers.get('Content-Type') or ''):
+            params.update(json.loads(body))
+          else:
+            params.update(parse_qsl(body))
+        status, payload = api.handle(method, params)
+        data = json.dumps(payload).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
+
+
+class FinishMiddleware(Middleware):
+  """
+  Reports every handled update to the #FakeBotApi. Add it as the last
+  middleware; its #after_handle_update() is also called for updates that an
+  earlier middleware ended.
+  """
+
+  def __init__(self, api):
+    self.api = api
+
+  def before_handle_update(self):
+    pass
+
+  def after_handle_update(self):
+    self.api.finish(update.update_id,
+      shed=bool(getattr(g, 'shed_reason', None)),
+      failed=bool(getattr(g, 'failed_reason', None)))
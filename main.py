@@ -1,26 +1,38 @@
 
-from telegram.ext import Updater, Filters
-from telegram.ext import InlineQueryHandler, MessageHandler
-from telegram import ChatAction, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
+from datetime import datetime
 from textwrap import dedent
-from werkzeug.local import Local
+from werkzeug.local import LocalProxy
 
 import functools
+import importlib
 import logging
 import types
 
 import config from './config.json'
-import db from './db'
 import {escape_markdown} from './utils'
 import {
   Application, g,
   update, command,
-  reply_text, chat_action
+  reply_text, deferred_chat_action
 } from './base/app'
+import {AdmissionController} from './base/admission'
 
+# python-telegram-bot and the database are imported on first use, so that
+# the command registry (eg. for manage.py) can be imported cheaply and
+# without connecting to the database.
+telegram = LocalProxy(lambda: importlib.import_module('telegram'))
+db = LocalProxy(lambda: require('./db'))
 
 # Our chatbot :3
-app = Application('KwittBot', debug=True)
+app = Application('KwittBot', debug=True,
+  chat_action_delay=config.get('chatActionDelay', 0.5))
+
+# The configured db.Storage, created on first use.
+storage = LocalProxy(lambda: db.get_storage())
+
+# Shed bursts of updates before they reach the database.
+admission = AdmissionController.from_config(config.get('admission', {}))
+app.add_middleware(admission)
 
 # We don't use a proxy for the user object yet, because MongoEngine has
 # trouble processing it!
@@ -34,7 +46,7 @@ def requires_user(func):
 
   @functools.wraps(func)
   def wrapper(*args, **kwargs):
-    if not user:
+    if not g.user:
       register_user()
     return func(*args, **kwargs)
 
@@ -47,13 +59,19 @@ def user_middleware():
   # available in g.user.
   user = None
   if update.effective_user:
-    try:
-      user = db.User.objects(telegram_id=update.effective_user.id).get()
-    except db.User.DoesNotExist:
-      user = None
+    user = storage.get_user(update.effective_user.id)
   g.user = user
 
 
+@app.middleware
+def read_preference_middleware():
+  # Route the queries of read-only commands to secondaries, unless the
+  # user has just changed data that they must be able to read back.
+  if g.readonly and not (g.user and db.has_recent_write(g.user)):
+    db.route_reads(True)
+    return functools.partial(db.route_reads, False)
+
+
 @app.middleware
 def logging_middleware():
   if g.command:
@@ -64,8 +82,8 @@ def logging_middleware():
 def start():
   " Register to @KwittBot. "
 
-  chat_action('typing')
-  if user:
+  deferred_chat_action('typing')
+  if g.user:
     reply_text("We already got you covered. Type /help when you're stuck!")
   else:
     register_user()
@@ -76,41 +94,34 @@ def start():
 def send():
   " Send money to a friend. "
 
-  chat_action('typing')
+  deferred_chat_action('typing')
   result = parse_send_or_request('send', command.text)
   if not result:
     return
 
   amount, target, description = result
-  if amount > g.user.balance:
+
+  # Create a new transaction between the current user and the target. This
+  # also updates both user's balance.
+  try:
+    storage.append_transaction(target, amount, sender=g.user, description=description)
+  except db.InsufficientFunds as exc:
     reply_text(
       "Sorry, your balance is {}. You can not send {} to @{}!"
-      .format(g.user.balance, amount, target.username)
+      .format(exc.balance, amount, target.username)
     )
     return
 
-  # Create a new transaction between the current user and the target.
-  transaction = db.Transaction(
-    amount=amount,
-    receiver=target,
-    sender=g.user,
-    gateway_details=None,
-    description=description
-  )
-  transaction.save()
-
-  # Update both user's balance.
-  g.user.update_balance()
-  target.update_balance()
+  # Notify the target in the background.
+  db.Notification.create(
+    target.chat_id,
+    "You just received {} from @{}."
+    .format(amount, g.user.username)
+  ).save()
 
   reply_text(
     "You have sent {} to @{}. You're new balance is {}."
-    .format(amount, target.username, user.balance)
-  )
-  reply_text(
-    "You just received {} from @{}."
-    .format(amount, user.username),
-    chat_id=target.chat_id
+    .format(amount, target.username, g.user.balance)
   )
 
 @app.command
@@ -118,99 +129,171 @@ def send():
 def request():
   " Request money from a friend. "
 
-  chat_action('typing')
+  deferred_chat_action('typing')
   result = parse_send_or_request('send', command.text)
   if not result:
     return
 
   amount, target, description = result
 
-  # Issue a new request to the target user.
-  request = db.Request(
-    issuer=g.user,
-    target=target,
-    amount=amount,
-    description=description,
-    mode=db.Request.Modes.OPEN
-  )
-  request.save()
+  # Issue a new request to the target user and notify them.
+  request = storage.create_request(g.user, target, amount, description)
+  create_request_notification(request).save()
 
   reply_text(
     "You have requested {} from @{}."
     .format(amount, target.username)
   )
 
-  # Buttons to answer the request.
-  markup = InlineKeyboardMarkup([
-    [
-      InlineKeyboardButton('Send {}'.format(amount), callback_data='send:' + str(request.id)),
-      InlineKeyboardButton('Reject', callback_data='reject:' + str(request.id)),
-    ]
-  ])
 
-  # Send a message to the user that the money is being requested from.
-  their_msg = '\nTheir message: "{}"'.format(description) if description else ""
+@app.command
+@requires_user
+def split():
+  " Split a bill with friends: /split AMOUNT @USER... [DESCRIPTION] "
+
+  deferred_chat_action('typing')
+  parts = command.text.strip().split()
+  names = []
+  end = 1
+  for part in parts[1:]:
+    if not part.startswith('@'):
+      break
+    end += 1
+    if part[1:].lower() not in (x.lower() for x in names):
+      names.append(part[1:])
+  if not names:
+    reply_text('Syntax is /split AMOUNT @USER... [DESCRIPTION]')
+    return
+
+  try:
+    amount = db.Decimal(parts[0])
+  except db.decimal.InvalidOperation:
+    reply_text('The amount you specified is invalid: {!r}'.format(parts[0]))
+    return
+  if amount <= 0:
+    reply_text('The amount must be positive: {!r}'.format(parts[0]))
+    return
+
+  # Find all specified users with a single query.
+  users = storage.find_users(names)
+  missing = [name for name in names if name.lower() not in users]
+  if missing:
+    reply_text(
+      "Sorry, I could not find {}. Maybe they are not using @KwittBot, yet?"
+      .format(', '.join('@' + name for name in missing))
+    )
+    return
+  targets = [users[name.lower()] for name in names]
+  if any(t.id == g.user.id for t in targets) and not config['settings']['allowSendToSelf']:
+    reply_text("Sorry, you can not specify yourself in this command.")
+    return
+
+  # The amount is split evenly between the issuer and all targets.
+  share = (amount / (len(targets) + 1)).quantize(db.Decimal('0.01'), db.decimal.ROUND_HALF_UP)
+  if share <= 0:
+    reply_text('The amount is too small to be split between {} people.'.format(len(targets) + 1))
+    return
+  description = ' '.join(parts[end:])
+
+  # Issue all requests with a single insert and queue the notifications
+  # as a batch for the outbox dispatcher.
+  requests = storage.create_requests(g.user, targets, share, description)
+  db.Notification.save_all([create_request_notification(r) for r in requests])
+
   reply_text(
-    ("@{} requested you to send {}." + their_msg)
-    .format(g.user.username, amount, description),
-    chat_id=target.chat_id,
-    reply_markup=markup
+    "You have requested {} each from {}."
+    .format(share, ', '.join('@' + t.username for t in targets))
   )
 
 
-@app.command
+@app.command(readonly=True)
 @requires_user
 def balance():
   " Check your current balance on @KwittBot. "
 
-  chat_action('typing')
-  g.user.update_balance()
+  deferred_chat_action('typing')
+  balance = storage.get_balance(g.user)
 
   reply_text(
-    'Your current balance is *{}*.'.format(g.user.balance),
-    parse_mode=ParseMode.MARKDOWN
+    'Your current balance is *{}*.'.format(balance),
+    parse_mode=telegram.ParseMode.MARKDOWN
   )
 
 
-@app.command
+@app.command(readonly=True)
 @requires_user
 def transactions():
   " Show your transaction history. "
 
-  chat_action('typing')
+  deferred_chat_action('typing')
 
   # TODO: Parse arguments and display transactions accordingly.
 
-  transactions = g.user.get_transactions()
+  transactions = storage.get_transactions(g.user)
   if not transactions:
     reply_text(
       "There are no transactions on your account, yet."
     )
     return
 
+  # Look up the usernames of all counterparties with a single query.
+  user_ids = set(t.sender_id for t in transactions if t.sender_id)
+  user_ids.update(t.receiver_id for t in transactions)
+  users = storage.get_user_refs(user_ids)
+
   # Build a list of the transactions.
   lines = [
     'Showing {} out of {} transactions:'
     .format(len(transactions), len(transactions))
   ]
   for t in transactions:
-    gain = False
-    if t.receiver == g.user:
-      gain = True
-      if not t.sender:
-        msg = 'from {}'.format(t.gateway_details.provider)
-      elif t.sender == t.receiver:
+    if t.receiver_id == g.user.id:
+      if not t.sender_id:
+        msg = 'from {}'.format(t.provider)
+      elif t.sender_id == t.receiver_id:
         msg = 'to yourself'
       else:
-        msg = 'from @{}'.format(t.sender.username)
-    elif t.sender == g.user:
-      msg = 'to @{}'.format(t.receiver.username)
+        msg = 'from @{}'.format(users[t.sender_id].username)
+    elif t.sender_id == g.user.id:
+      msg = 'to @{}'.format(users[t.receiver_id].username)
 
     msg += ' ({})'.format(t.date.strftime('%Y-%m-%d %H:%M'))
     lines.append('*{}* '.format(t.amount) + escape_markdown(msg))
 
   message = '\n'.join(lines)
-  reply_text(message, parse_mode=ParseMode.MARKDOWN)
+  reply_text(message, parse_mode=telegram.ParseMode.MARKDOWN)
+
+
+@app.command(readonly=True)
+@requires_user
+def stats():
+  " Summarize your transactions: /stats [month|year] "
+
+  deferred_chat_action('typing')
+  period = command.text.strip().lower() or 'month'
+  today = datetime.now()
+  if period == 'month':
+    start = datetime(today.year, today.month, 1)
+    end = datetime(today.year + today.month // 12, today.month % 12 + 1, 1)
+    title = start.strftime('%B %Y')
+  elif period == 'year':
+    start = datetime(today.year, 1, 1)
+    end = datetime(today.year + 1, 1, 1)
+    title = str(today.year)
+  else:
+    reply_text('Syntax is /stats [month|year]')
+    return
+
+  summary = storage.get_summary(g.user, start, end)
+  reply_text(
+    'Your statistics for {}:\n'
+    'Received *{}* in {} transactions\n'
+    'Sent *{}* in {} transactions\n'
+    'Counterparties: {}'
+    .format(title, summary.received, summary.received_count, summary.sent,
+      summary.sent_count, summary.counterparties),
+    parse_mode=telegram.ParseMode.MARKDOWN
+  )
 
 
 @app.command
@@ -218,7 +301,7 @@ def transactions():
 def credit():
   " Charge your account (eg. via PayPal). "
 
-  chat_action('typing')
+  deferred_chat_action('typing')
   amount = command.text.strip()
   try:
     amount = db.Decimal(amount)
@@ -226,27 +309,12 @@ def credit():
     reply_text("The amount you entered is invalid: {!r}".format(amount))
     return
 
-  # Create a new transaction from a payment gateway.
-  details = db.GatewayTransactionDetails(provider='telegram_credit_command')
-
-  # And a new transaction from the gateway to the user.
-  transaction = db.Transaction(
-    amount=amount,
-    receiver=g.user,
-    sender=None,
-    gateway_details=details
-  )
-
-  # FIXME: Two-phase transaction to ensure either both objects are saved
-  #        or none!
-  details.save()
-  transaction.save()
-
-  # Update the users balance/
-  g.user.update_balance()
+  # Create a new transaction from a payment gateway to the user. This also
+  # updates the users balance.
+  storage.append_transaction(g.user, amount, provider='telegram_credit_command')
   reply_text(
     "You've been credited *{}*.".format(amount),
-    parse_mode=ParseMode.MARKDOWN
+    parse_mode=telegram.ParseMode.MARKDOWN
   )
 
 
@@ -264,23 +332,26 @@ def callback_data():
   data = query.data
   if data.startswith('send:') or data.startswith('reject:'):
     request_id = data.partition(':')[2]
-    request = db.Request.objects(id=request_id).first()
+    request = storage.get_request(request_id)
     if not request:
       reply_text('Error: Request "{}" does not exist.'.format(request_id))
       return
 
-    if request.target != g.user:
+    if request.target_id != g.user.id:
       # That's a security issue. Ideally, other users wouldn't be able
       # to find out the ID of a request targeting a different user.
+      target = storage.get_user_refs([request.target_id])[request.target_id]
       app.logger.warning('User @%s (id: %s) was trying to answer request '
         '%s which is actually targeted to @%s (id: %s)', g.user.username,
-        g.user.telegram_id, request.id, request.target.username,
-        request.target.telegram_id)
+        g.user.telegram_id, request.id, target.username, target.telegram_id)
 
       reply_text("Wait wait wait, that's not your money request! What are you doing here?!")
       return
 
-    if request.mode != request.Modes.OPEN:
+    mode = request.Modes.FULFILLED if data.startswith('send:') else request.Modes.REJECTED
+    try:
+      storage.set_request_mode(request, mode)
+    except db.RequestStateError:
       reply_text("The request is not open anymore.")
       return
 
@@ -288,23 +359,42 @@ def callback_data():
     if data.startswith('send:'):
       reply_text('TODO: Implement sending a request (I marked it '
         'as fulfilled nevertheless)')
-      request.mode = request.Modes.FULFILLED
-      request.save()
     else:
-      reply_text("You rejected the request.")
-      request.mode = request.Modes.REJECTED
-      request.save()
-      reply_text(
+      issuer = storage.get_user_refs([request.issuer_id])[request.issuer_id]
+      db.Notification.create(
+        issuer.chat_id,
         "@{} rejected your request for {}."
-        .format(g.user.username, request.amount),
-        chat_id=request.issuer.chat_id
-      )
+        .format(g.user.username, request.amount)
+      ).save()
+      reply_text("You rejected the request.")
+
+
+def create_request_notification(request):
+  """
+  Creates a #db.Notification for the target of a request with buttons to
+  answer the request. The notification is not saved.
+  """
+
+  markup = telegram.InlineKeyboardMarkup([
+    [
+      telegram.InlineKeyboardButton('Send {}'.format(request.amount), callback_data='send:' + str(request.id)),
+      telegram.InlineKeyboardButton('Reject', callback_data='reject:' + str(request.id)),
+    ]
+  ])
+  description = request.description
+  their_msg = '\nTheir message: "{}"'.format(description) if description else ""
+  return db.Notification.create(
+    request.target.chat_id,
+    ("@{} requested you to send {}." + their_msg)
+    .format(request.issuer.username, request.amount, description),
+    reply_markup=markup
+  )
 
 
 def register_user():
   # Create a new user.
-  g.user = db.User.from_telegram_user(g.update.effective_chat, g.update.effective_user)
-  g.user.save()
+  chat, user = g.update.effective_chat, g.update.effective_user
+  g.user = storage.create_user(chat.id, user.id, user.username, user.name, user.language_code)
 
   reply_text(
     "Hi {}! Seems like this is your first time here. You can now use "
@@ -333,10 +423,13 @@ def parse_send_or_request(cmd, text):
   except db.decimal.InvalidOperation:
     reply_text('The amount you specified is invalid: {!r}'.format(parts[0]))
     return False
+  if amount <= 0:
+    reply_text('The amount must be positive: {!r}'.format(parts[0]))
+    return False
 
   # Find the specified @USER.
   target_name = parts[1][1:]
-  target = db.User.objects(username__iexact=target_name).first()
+  target = storage.find_user(target_name)
   if not target:
     reply_text(
       "Sorry, I could not find @{}. Maybe they are not using "
@@ -345,7 +438,7 @@ def parse_send_or_request(cmd, text):
     )
     return False
 
-  if target == g.user and not config['settings']['allowSendToSelf']:
+  if target.id == g.user.id and not config['settings']['allowSendToSelf']:
     reply_text("Sorry, you can not specify yourself in this command.")
     return
 
@@ -355,17 +448,36 @@ def main():
   logging.basicConfig(format='[%(levelname)s - %(asctime)s]: %(message)s', level=logging.INFO)
   logging.info('Firing up KwittBot ...')
 
+  from telegram.ext import Updater
+  OutboxDispatcher = require('./outbox').OutboxDispatcher
+  RequestSweeper = require('./expiry').RequestSweeper
+
   updater = Updater(config['telegramApiToken'])
-  updater.dispatcher.add_handler(app)
+  updater.dispatcher.add_handler(app.handler())
   updater.dispatcher.add_error_handler(app.handle_error)
   updater.start_polling()
 
+  outbox = OutboxDispatcher.from_config(updater.bot, config.get('outbox', {}))
+  outbox.start()
+
+  sweeper = RequestSweeper.from_config(db.get_storage(), config.get('requests', {}))
+  if sweeper:
+    sweeper.start()
+
   logging.info('Connecting to MongoDB ...')
   db.User.objects().first()  # Fake query, so that a connection will be established
+  logging.info('Using %s ...', type(db.get_storage()).__name__)
 
   logging.info('Polling started, entering IDLE ...')
   updater.idle()
 
+  logging.info('Stopping outbox dispatcher ...')
+  outbox.stop()
+  if sweeper:
+    sweeper.stop()
+
+  logging.info('Admission counters: %s', admission.stats())
+
 
 if require.main == module:
   main()
@@ -1,7 +1,26 @@
 
+from datetime import datetime, timedelta
+
+from werkzeug.local import LocalProxy
+
 import click
-import db from './db'
-import {app} from './main'
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import config from './config.json'
+import {benchmark_storage, benchmark_reads} from './db/bench'
+import {FakeBotApi, FinishMiddleware} from './loadtest/fakeapi'
+import {percentile} from './utils'
+import {app, admission} from './main'
+
+# Imported on first use, so that commands that do not need the database
+# start quickly and do not connect to it.
+db = LocalProxy(lambda: require('./db'))
+
+#: Modules that must not be imported just to load the command registry.
+HEAVY_MODULES = ['telegram', 'mongoengine', 'pymongo', 'sqlalchemy']
 
 
 @click.group()
@@ -24,9 +43,190 @@ def drop(users):
   print('Dropping Transaction ...')
   db.Transaction.drop_collection()
 
+  print('Dropping ArchivedTransaction ...')
+  db.ArchivedTransaction.drop_collection()
+
+  print('Dropping BalanceCheckpoint ...')
+  db.BalanceCheckpoint.drop_collection()
+
   print('Dropping Request ...')
   db.Request.drop_collection()
 
+  print('Dropping Notification ...')
+  db.Notification.drop_collection()
+
+  print('Dropping DailyRollup ...')
+  db.DailyRollup.drop_collection()
+
+
+@main.command()
+@click.option('--include-today', is_flag=True, help='Also rebuild the rollups '
+  'of the current day. Only use this while the bot is not running.')
+def rollup(include_today):
+  " Rebuild the daily rollups from the transaction history. "
+
+  until = datetime.now() if include_today else None
+  print('Rebuilding DailyRollup ...')
+  count = db.DailyRollup.rebuild(
+    db.ArchivedTransaction.objects.order_by('date'),
+    db.Transaction.objects.order_by('date'),
+    until=until)
+  print('Rebuilt {} rollups.'.format(count))
+
+
+@main.command()
+@click.option('--keep-days', type=int, help='Number of days of transactions '
+  'to keep in the hot ledger. Defaults to ledger.keepDays in config.json.')
+def compact(keep_days):
+  " Checkpoint balances and archive old transactions. "
+
+  if keep_days is None:
+    keep_days = config.get('ledger', {}).get('keepDays', 365)
+  today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+  cutoff = today - timedelta(days=keep_days)
+
+  print('Compacting transactions up to {} ...'.format(cutoff))
+  checkpoints, archived = db.compact(cutoff)
+  print('Created {} checkpoints and archived {} transactions.'.format(checkpoints, archived))
+
+
+@main.command('bench-storage')
+@click.option('--backend', type=click.Choice(['mongo', 'sql']), default='sql')
+@click.option('--url', help='SQLAlchemy database URL for the sql backend. '
+  'Defaults to a temporary SQLite database.')
+@click.option('--users', default=100, help='Number of users to create.')
+@click.option('--operations', default=2000, help='Number of operations.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation '
+  'before writing to the configured MongoDB.')
+def bench_storage(backend, url, users, operations, yes):
+  " Measure the latency of storage operations. "
+
+  tempdir = None
+  if backend == 'mongo':
+    if not yes:
+      click.confirm('This creates benchmark users and transactions in the '
+        'configured MongoDB. Continue?', abort=True)
+    storage = db.MongoStorage()
+  else:
+    if not url:
+      tempdir = tempfile.mkdtemp()
+      url = 'sqlite:///' + os.path.join(tempdir, 'bench.db')
+    storage = require('./db/sql').SqlStorage(url)
+
+  print('Benchmarking {} ({} users, {} operations) ...'.format(
+    type(storage).__name__, users, operations))
+  timings = benchmark_storage(storage, users, operations)
+
+  print('{:<20} {:>8} {:>10} {:>10} {:>10}'.format(
+    'operation', 'count', 'ops/s', 'p50 (ms)', 'p99 (ms)'))
+  for name, values in timings.items():
+    print('{:<20} {:>8} {:>10.1f} {:>10.2f} {:>10.2f}'.format(
+      name, len(values), len(values) / sum(values),
+      percentile(values, 50) * 1000, percentile(values, 99) * 1000))
+
+  if tempdir:
+    os.remove(os.path.join(tempdir, 'bench.db'))
+    os.rmdir(tempdir)
+
+
+@main.command('bench-reads')
+@click.option('--rows', default=10000, help='Number of transactions.')
+def bench_reads(rows):
+  " Compare full documents with projected records for transaction reads. "
+
+  print('Building {} transactions per read path ...'.format(rows))
+  results = benchmark_reads(db, rows)
+  print('{:<12} {:>14} {:>14} {:>14}'.format('path', 'CPU (us/row)',
+    'bytes/row', 'blocks/row'))
+  for name, (cpu, size, blocks) in results.items():
+    print('{:<12} {:>14.2f} {:>14.0f} {:>14.1f}'.format(name, cpu * 1e6, size, blocks))
+
+
+@main.command()
+@click.option('--chats', default=1000, help='Number of simulated chats.')
+@click.option('--updates', default=5000, help='Number of updates to send.')
+@click.option('--rate', default=200.0, help='Updates per second.')
+@click.option('--text', default='/balance', help='The message to send. '
+  'The latency is measured up to the first reply.')
+@click.option('--latency', default=0.0, help='Seconds to delay every Bot API response.')
+@click.option('--error-rate', default=0.0, help='Fraction of outgoing calls '
+  'that are answered with a 429 error.')
+@click.option('--drain-timeout', default=30.0, help='Seconds to wait for '
+  'outstanding replies.')
+@click.option('--outbox/--no-outbox', default=True, help='Run the outbox dispatcher.')
+@click.option('--max-p99', type=float, help='Fail if any update failed or '
+  'the p99 latency exceeds this many milliseconds.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation '
+  'before writing to the configured database.')
+def loadtest(chats, updates, rate, text, latency, error_rate, drain_timeout,
+             outbox, max_p99, yes):
+  " Drive the bot end-to-end against a local fake Bot API. "
+
+  from telegram.ext import Updater
+  OutboxDispatcher = require('./outbox').OutboxDispatcher
+
+  if not yes:
+    click.confirm('This registers {} simulated users in the configured '
+      'database. Continue?'.format(chats), abort=True)
+
+  api = FakeBotApi(latency=latency, error_rate=error_rate)
+  api.start()
+  app.add_middleware(FinishMiddleware(api))
+  updater = Updater('123456:loadtest', base_url=api.base_url)
+  updater.dispatcher.add_handler(app.handler())
+  updater.dispatcher.add_error_handler(app.handle_error)
+  dispatcher = None
+  if outbox:
+    dispatcher = OutboxDispatcher.from_config(updater.bot, config.get('outbox', {}))
+    dispatcher.start()
+  updater.start_polling(poll_interval=0, timeout=1)
+
+  try:
+    # Register all simulated users first (/start is answered exactly once
+    # either way), so that registration is not part of the measurement.
+    # Chat IDs are far above real Telegram user IDs.
+    chat_ids = [10 ** 12 + i for i in range(chats)]
+    print('Registering {} chats ...'.format(chats))
+    for chat_id in chat_ids:
+      api.push_message(chat_id, '/start')
+    api.wait(drain_timeout)
+    api.reset_stats()
+
+    print('Sending {} updates at {}/s ...'.format(updates, rate))
+    start = time.perf_counter()
+    api.feed(chat_ids, text, updates, rate)
+    api.wait(drain_timeout)
+    duration = time.perf_counter() - start
+  finally:
+    updater.stop()
+    if dispatcher:
+      dispatcher.stop()
+    api.stop()
+
+  counters, latencies = api.stats()
+  print('Updates:    {} in {:.1f}s ({:.1f}/s)'.format(counters['updates'],
+    duration, counters['updates'] / duration))
+  print('Replied:    {}'.format(counters['replied']))
+  print('Shed:       {}'.format(counters['shed']))
+  print('Failed:     {} (exception or 429 on the reply)'.format(counters['failed']))
+  print('Unanswered: {} ({} still pending)'.format(counters['unanswered'], counters['pending']))
+  print('Unsolicited messages: {}'.format(counters['unsolicited']))
+  print('429s:       {}'.format(counters['429']))
+  if latencies:
+    print('Latency of replied updates:')
+    print('p50:        {:.1f} ms'.format(percentile(latencies, 50) * 1000))
+    print('p99:        {:.1f} ms'.format(percentile(latencies, 99) * 1000))
+  print('Admission:  {}'.format(admission.stats()))
+
+  missing = counters['unanswered'] + counters['pending']
+  if missing:
+    raise click.ClickException('{} updates were not answered.'.format(missing))
+  if max_p99 is not None:
+    if counters['failed']:
+      raise click.ClickException('{} updates failed.'.format(counters['failed']))
+    if latencies and percentile(latencies, 99) * 1000 > max_p99:
+      raise click.ClickException('p99 latency exceeds {} ms.'.format(max_p99))
+
 
 @main.command('format-command-list')
 def format_command_list():
@@ -35,5 +235,26 @@ def format_command_list():
     print(line)
 
 
+@main.command('check-startup')
+@click.option('--budget', default=0.5, help='Maximum number of seconds for '
+  'a cold start of format-command-list.')
+@click.option('--nodepy', default='nodepy', help='The Node.py executable.')
+def check_startup(budget, nodepy):
+  " Check that the CLI starts quickly and without side effects. "
+
+  loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+  if loaded:
+    raise click.ClickException('Importing the command registry also '
+      'imported {}.'.format(', '.join(loaded)))
+
+  start = time.perf_counter()
+  subprocess.check_call([nodepy, __file__, 'format-command-list'],
+    stdout=subprocess.DEVNULL)
+  duration = time.perf_counter() - start
+  print('format-command-list took {:.3f}s (budget {:.3f}s).'.format(duration, budget))
+  if duration > budget:
+    raise click.ClickException('CLI cold start exceeds the budget.')
+
+
 if require.main == module:
   main()
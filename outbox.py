@@ -0,0 +1,90 @@
+
+from datetime import datetime, timedelta
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+
+import random
+
+import db from './db'
+import {TokenBucket} from './base/ratelimit'
+import {Worker} from './base/worker'
+
+
+class OutboxDispatcher(Worker):
+  """
+  Delivers pending #db.Notification#s in batches. Sending is throttled by a
+  #TokenBucket to stay below Telegram's rate limits. Failed deliveries are
+  retried with exponential backoff until *max_attempts* is reached, errors
+  that can not be resolved by retrying (eg. the user blocked the bot) fail
+  the notification immediately.
+  """
+
+  def __init__(self, bot, batch_size=50, poll_interval=1.0, max_attempts=8,
+               backoff_base=2.0, backoff_max=600.0, rate=25, burst=30):
+    super().__init__('OutboxDispatcher', poll_interval)
+    self.bot = bot
+    self.batch_size = batch_size
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.limiter = TokenBucket(rate, burst)
+
+  @classmethod
+  def from_config(cls, bot, config):
+    return cls(
+      bot,
+      batch_size=config.get('batchSize', 50),
+      poll_interval=config.get('pollInterval', 1.0),
+      max_attempts=config.get('maxAttempts', 8),
+      backoff_base=config.get('backoffBase', 2.0),
+      backoff_max=config.get('backoffMax', 600.0),
+      rate=config.get('messagesPerSecond', 25),
+      burst=config.get('burst', 30)
+    )
+
+  def run_once(self):
+    batch = list(db.Notification.get_due(self.batch_size))
+    for notification in batch:
+      self.limiter.wait()
+      self.deliver(notification)
+    return len(batch) == self.batch_size
+
+  def deliver(self, notification):
+    notification.attempts += 1
+    try:
+      self.bot.sendMessage(
+        notification.chat_id,
+        notification.text,
+        parse_mode=notification.parse_mode,
+        reply_markup=notification.reply_markup
+      )
+    except RetryAfter as exc:
+      self.retry(notification, exc, exc.retry_after)
+    except (BadRequest, Unauthorized) as exc:
+      self.logger.warning('Notification %s failed permanently: %s', notification.id, exc)
+      notification.mode = notification.Modes.FAILED
+      notification.error = str(exc)
+    except Exception as exc:
+      self.retry(notification, exc, self.backoff(notification.attempts))
+    else:
+      notification.mode = notification.Modes.SENT
+      notification.error = None
+    notification.save()
+
+  def retry(self, notification, exc, delay):
+    notification.error = str(exc)
+    if notification.attempts >= self.max_attempts:
+      self.logger.error('Notification %s failed after %d attempts: %s',
+        notification.id, notification.attempts, exc)
+      notification.mode = notification.Modes.FAILED
+    else:
+      notification.next_attempt = datetime.now() + timedelta(seconds=delay)
+
+  def backoff(self, attempts):
+    """
+    Returns the delay in seconds before the next delivery attempt. The delay
+    grows exponentially with the number of *attempts* and is jittered to
+    avoid retrying many notifications at the same time.
+    """
+
+    delay = min(self.backoff_max, self.backoff_base ** attempts)
+    return delay * random.uniform(0.5, 1.0)
@@ -5,3 +5,10 @@ def escape_markdown(text):
   """Helper function to escape telegram markup symbols"""
   escape_chars = '\*_`\['
   return re.sub(r'([%s])' % escape_chars, r'\\\1', text)
+
+def percentile(values, p):
+  """Returns the *p*-th percentile (0-100) of a sorted list of *values*."""
+  if not values:
+    return None
+  index = int(round((len(values) - 1) * p / 100.0))
+  return values[index]